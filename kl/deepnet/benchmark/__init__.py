@@ -0,0 +1,7 @@
+'''
+性能测试
+每个模块都可以单独运行，例如:
+    python -m kl.deepnet.benchmark.sync_overhead
+不带模块名时执行训练吞吐量测试:
+    python -m kl.deepnet.benchmark
+'''
@@ -0,0 +1,5 @@
+import sys
+
+from .throughput import main
+
+sys.exit(main())
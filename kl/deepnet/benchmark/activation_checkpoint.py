@@ -0,0 +1,117 @@
+'''
+激活检查点的内存和耗时测试
+对每个模型比较不使用、部分阶段使用、全部阶段使用激活检查点，以及不同的分段粒度
+记录训练一步的内存峰值增量和耗时
+    python -m kl.deepnet.benchmark.activation_checkpoint
+    python -m kl.deepnet.benchmark.activation_checkpoint --device cuda --input-height 224
+'''
+import argparse
+import time
+
+import torch as tc
+import torch.nn as nn
+
+from ..model.resnet import ResNet, ResNetWithBottleNeck
+from ..nn import VGG
+from ..trainer.batch_finder import MemoryMonitor
+from .util import run_isolated
+
+
+C_IN = 3
+NUM_CLASS = 10
+
+# 设置名-(checkpoint_stages, checkpoint_segments)
+SETTINGS = {
+    'none': (None, 1),
+    'last stage': ([-1], 1),
+    'all, per stage': ('all', 1),
+    'all, per 2 blocks': ('all', 2),
+    'all, per block': ('all', 100),
+}
+
+
+def build(model: str, input_height: int, checkpoint_stages, checkpoint_segments):
+    num_stage = 5 if model == 'vgg' else 4
+    if isinstance(checkpoint_stages, list):
+        # 负数序号从最后一个阶段算起
+        checkpoint_stages = [idx % num_stage for idx in checkpoint_stages]
+    kwargs = {'checkpoint_stages': checkpoint_stages,
+              'checkpoint_segments': checkpoint_segments}
+    if model == 'resnet':
+        return ResNet(C_IN, NUM_CLASS, c_base=32, **kwargs)
+    if model == 'resnet_bottleneck':
+        return ResNetWithBottleNeck(C_IN, NUM_CLASS, c_base=16,
+                                    c_linear=16*32, **kwargs)
+    return VGG(C_IN, NUM_CLASS, c_base=16, fc_hid=512,
+               input_height=input_height, **kwargs)
+
+
+def measure(model: str,
+            setting: str,
+            batch_size: int = 8,
+            input_height: int = 128,
+            device: str = 'cpu',
+            num_step: int = 3) -> dict:
+    '''训练若干步，返回内存峰值增量(MB)和每步耗时(秒)，应在独立的子进程中调用'''
+    _ = tc.manual_seed(0)
+    device = tc.device(device)
+    checkpoint_stages, checkpoint_segments = SETTINGS[setting]
+    net = build(model, input_height, checkpoint_stages, checkpoint_segments).to(device)
+    optimizer = tc.optim.SGD(net.parameters(), lr=0.01)
+    loss_fn = nn.CrossEntropyLoss()
+    X = tc.randn(batch_size, C_IN, input_height, input_height, device=device)
+    Y = tc.randint(0, NUM_CLASS, (batch_size,), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        loss_fn(net(X), Y).backward()
+        optimizer.step()
+
+    # 预热，使优化器状态和缓存的内存不计入
+    step()
+    if device.type == 'cuda':
+        tc.cuda.synchronize(device)
+
+    monitor = MemoryMonitor(device)
+    memory_begin = monitor.current_mb()
+    with monitor:
+        time_begin = time.perf_counter()
+        for _ in range(num_step):
+            step()
+        if device.type == 'cuda':
+            tc.cuda.synchronize(device)
+        time_delta = time.perf_counter() - time_begin
+    return {'memory_mb': monitor.peak_mb - memory_begin,
+            'step_time': time_delta / num_step}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+',
+                        default=['resnet', 'resnet_bottleneck', 'vgg'])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--input-height', type=int, default=128)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--steps', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print('{:<20}{:<20}{:>16}{:>14}{:>10}'.format(
+        'model', 'setting', 'peak mem +(MB)', 'step(ms)', 'memory'))
+    for model in args.models:
+        baseline = None
+        for setting in SETTINGS:
+            result = run_isolated(measure, model, setting,
+                                  batch_size=args.batch_size,
+                                  input_height=args.input_height,
+                                  device=args.device,
+                                  num_step=args.steps)
+            if baseline is None:
+                baseline = result
+            print('{:<20}{:<20}{:>16.1f}{:>14.1f}{:>9.0%}'.format(
+                model, setting, result['memory_mb'], result['step_time']*1e3,
+                result['memory_mb'] / max(baseline['memory_mb'], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
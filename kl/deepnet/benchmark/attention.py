@@ -0,0 +1,88 @@
+'''
+点积注意力的内存和延迟测试
+比较原来的实现(完整的分数矩阵)、scaled_dot_product_attention和分块计算，遍历不同的序列长度
+    python -m kl.deepnet.benchmark.attention
+    python -m kl.deepnet.benchmark.attention --lengths 1024 4096 16384 --device cuda
+'''
+import argparse
+import statistics
+import time
+
+import torch as tc
+import torch.nn.functional as F
+
+from ..function import chunked_attention
+from ..trainer.batch_finder import MemoryMonitor, is_oom_error
+
+
+def legacy_dot_attention(Q, K, V):
+    '''原来的实现，保存完整的分数矩阵和softmax结果'''
+    d = tc.tensor(K.shape[-1])
+    K_T = K.transpose(-1, -2).contiguous()
+    A_ = Q@K_T/tc.sqrt(d)
+    A = tc.softmax(A_, dim=-1)
+    return A@V
+
+
+IMPLEMENTATIONS = {
+    'legacy': legacy_dot_attention,
+    'sdpa': F.scaled_dot_product_attention,
+    'chunked': chunked_attention,
+}
+
+
+def measure(fn, Q, K, V, num_repeat: int = 5) -> dict:
+    '''返回延迟中位数(毫秒)和内存峰值增量(MB)'''
+    device = Q.device
+    is_cuda = device.type == 'cuda'
+    times = []
+    monitor = MemoryMonitor(device)
+    memory_begin = monitor.current_mb()
+    with tc.inference_mode(), monitor:
+        for _ in range(num_repeat):
+            time_begin = time.perf_counter()
+            _ = fn(Q, K, V)
+            if is_cuda:
+                tc.cuda.synchronize(device)
+            times.append(time.perf_counter() - time_begin)
+    return {'latency_ms': statistics.median(times)*1e3,
+            'memory_mb': monitor.peak_mb - memory_begin}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lengths', nargs='+', type=int,
+                        default=[256, 512, 1024, 2048, 4096])
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--width', type=int, default=64)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args(argv)
+
+    print('{:>8}{:>10}{:>14}{:>16}{:>12}'.format(
+        'length', 'impl', 'latency(ms)', 'peak mem +(MB)', 'max error'))
+    for length in args.lengths:
+        _ = tc.manual_seed(0)
+        Q, K, V = (tc.randn(args.batch_size, length, args.width, device=args.device)
+                   for _ in range(3))
+        reference = None
+        for name, fn in IMPLEMENTATIONS.items():
+            try:
+                result = measure(fn, Q, K, V)
+                with tc.inference_mode():
+                    Y = fn(Q, K, V)
+            except RuntimeError as error:
+                if not is_oom_error(error):
+                    raise
+                print('{:>8}{:>10}{:>14}'.format(length, name, 'oom'))
+                continue
+            if reference is None:
+                reference = Y
+            error = (Y - reference).abs().max().item()
+            Y = None
+            print('{:>8}{:>10}{:>14.2f}{:>16.1f}{:>12.2e}'.format(
+                length, name, result['latency_ms'], result['memory_mb'], error))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''
+权重加载的耗时和峰值内存测试
+比较完整读取.pth、内存映射读取.pth、分模块文件夹格式，以及只读取net的情况
+    python -m kl.deepnet.benchmark.checkpoint_load
+'''
+from typing import Optional
+import tempfile
+import time
+
+import torch as tc
+import torch.nn as nn
+
+from ..trainer import CheckpointManager
+from ..trainer.util import peak_rss_mb, current_rss_mb
+from .util import run_isolated
+
+
+def build(num_layer: int = 8, width: int = 2048):
+    '''网络和带有状态的优化器'''
+    net = nn.Sequential(*[nn.Linear(width, width) for _ in range(num_layer)])
+    optimizer = tc.optim.Adam(net.parameters())
+    return net, optimizer
+
+
+def prepare(root_dir: str, format: str, **kwargs) -> None:
+    '''保存一个记录点'''
+    net, optimizer = build(**kwargs)
+    # 执行一步，使优化器产生状态
+    net(tc.randn(4, net[0].in_features)).sum().backward()
+    optimizer.step()
+    manager = CheckpointManager(modObj={'net': net, 'optimizer': optimizer},
+                                root_dir=root_dir,
+                                format=format)
+    manager.save()
+
+
+def measure(root_dir: str,
+            format: str,
+            names: Optional[list] = None,
+            legacy: bool = False,
+            **kwargs) -> dict:
+    '''在子进程中加载，返回耗时和加载引起的峰值内存增量'''
+    net, optimizer = build(**kwargs)
+    modObj = {'net': net, 'optimizer': optimizer}
+    rss_begin = max(peak_rss_mb(), current_rss_mb())
+
+    time_begin = time.perf_counter()
+    if legacy:
+        # 完整读取整个文件
+        pth = tc.load(CheckpointManager(root_dir=root_dir).storage.get_path(1))
+        for name in names or modObj:
+            _ = modObj[name].load_state_dict(pth[name])
+    else:
+        manager = CheckpointManager(modObj=modObj,
+                                    root_dir=root_dir,
+                                    format=format)
+        _ = manager.load(names=names)
+    time_delta = time.perf_counter() - time_begin
+
+    return {'time': time_delta,
+            'peak_rss_delta': peak_rss_mb() - rss_begin}
+
+
+if __name__ == '__main__':
+    settings = [
+        ('pth, full read', 'pth', None, True),
+        ('pth, mmap', 'pth', None, False),
+        ('dir, all modules', 'dir', None, False),
+        ('pth, net only', 'pth', ['net'], False),
+        ('dir, net only', 'dir', ['net'], False),
+    ]
+    with tempfile.TemporaryDirectory() as root_dir:
+        for format in ['pth', 'dir']:
+            prepare(f'{root_dir}/{format}', format)
+
+        print('{:<20}{:>12}{:>18}'.format('setting', 'time(s)', 'peak RSS +(MB)'))
+        for name, format, names, legacy in settings:
+            result = run_isolated(measure, f'{root_dir}/{format}', format,
+                                  names=names, legacy=legacy)
+            print('{:<20}{:>12.3f}{:>18.1f}'.format(
+                name, result['time'], result['peak_rss_delta']))
@@ -0,0 +1,95 @@
+'''
+键值缓存的生成速度测试
+用若干层MultiHeadAttention自回归地生成序列，每步的输出作为下一步的输入
+比较不使用缓存(每步重新计算整个前缀)和使用缓存(每步只计算新位置)的吞吐量
+    python -m kl.deepnet.benchmark.kv_cache
+'''
+import argparse
+import time
+
+import torch as tc
+import torch.nn as nn
+
+from ..nn import MultiHeadAttention
+
+
+def build(num_layer: int, d_model: int, num_head: int) -> nn.ModuleList:
+    return nn.ModuleList([MultiHeadAttention(d_model, num_head)
+                          for _ in range(num_layer)])
+
+
+def generate_without_cache(layers, prompt, num_new: int):
+    '''每步对整个序列做因果注意力，取最后一个位置'''
+    X = prompt
+    for _ in range(num_new):
+        Y = X
+        for layer in layers:
+            Y = Y + layer(Y, is_causal=True)
+        X = tc.cat([X, Y[:, -1:]], dim=1)
+    return X
+
+
+def generate_with_cache(layers, prompt, num_new: int):
+    '''先计算提示部分，之后每步只输入新位置'''
+    Y = prompt
+    for layer in layers:
+        layer.reset_cache()
+        Y = Y + layer.prefill(Y)
+    outputs = [prompt]
+    token = Y[:, -1]
+    for _ in range(num_new):
+        outputs.append(token[:, None])
+        Y = token
+        for layer in layers:
+            Y = Y + layer.step(Y)
+        token = Y
+    return tc.cat(outputs, dim=1)
+
+
+def measure(fn, layers, prompt, num_new: int) -> float:
+    '''生成的吞吐量(新位置数/秒)'''
+    device = prompt.device
+    with tc.inference_mode():
+        # 预热
+        _ = fn(layers, prompt, 2)
+        if device.type == 'cuda':
+            tc.cuda.synchronize(device)
+        time_begin = time.perf_counter()
+        _ = fn(layers, prompt, num_new)
+        if device.type == 'cuda':
+            tc.cuda.synchronize(device)
+        time_delta = time.perf_counter() - time_begin
+    return len(prompt) * num_new / max(time_delta, 1e-9)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num-layer', type=int, default=4)
+    parser.add_argument('--d-model', type=int, default=256)
+    parser.add_argument('--num-head', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--prompt-length', type=int, default=64)
+    parser.add_argument('--num-new', nargs='+', type=int, default=[64, 256, 512])
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args(argv)
+
+    _ = tc.manual_seed(0)
+    layers = build(args.num_layer, args.d_model, args.num_head).to(args.device).eval()
+    prompt = tc.randn(args.batch_size, args.prompt_length, args.d_model,
+                      device=args.device)
+    for layer in layers:
+        layer.allocate_cache(args.batch_size,
+                             args.prompt_length + max(args.num_new))
+
+    print('{:>10}{:>20}{:>20}{:>10}'.format(
+        'new', 'no cache(tok/s)', 'cache(tok/s)', 'speedup'))
+    for num_new in args.num_new:
+        speed_plain = measure(generate_without_cache, layers, prompt, num_new)
+        speed_cache = measure(generate_with_cache, layers, prompt, num_new)
+        print('{:>10}{:>20.1f}{:>20.1f}{:>9.1f}x'.format(
+            num_new, speed_plain, speed_cache, speed_cache / speed_plain))
+
+
+if __name__ == '__main__':
+    main()
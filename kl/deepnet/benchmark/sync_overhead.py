@@ -0,0 +1,71 @@
+'''
+训练循环中逐批同步的开销测试
+比较逐批取出损失和精度(sync_interval=1)、每隔K批取出、以及完全不打印三种情况下的单步耗时
+'''
+import contextlib
+import io
+import tempfile
+import time
+
+import torch as tc
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from ..trainer import Trainer, Accuracy
+
+
+def run(sync_interval: int = 1,
+        verbose: int = 2,
+        num_sample: int = 8192,
+        batch_size: int = 32,
+        num_feature: int = 64,
+        num_epoch: int = 3,
+        device: str = 'cpu') -> float:
+    '''
+    训练一个小型的全连接网络，返回平均每步耗时(秒)
+    网络很小，单步耗时主要由循环本身的开销决定
+    '''
+    _ = tc.manual_seed(0)
+    X = tc.randn(num_sample, num_feature)
+    Y = tc.randint(0, 10, (num_sample,))
+    loader = DataLoader(TensorDataset(X, Y), batch_size=batch_size)
+
+    net = nn.Sequential(nn.Linear(num_feature, 64),
+                        nn.ReLU(),
+                        nn.Linear(64, 10)).to(device)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        trainer = Trainer(net=net,
+                          loss_fn=nn.CrossEntropyLoss(),
+                          optimizer=tc.optim.SGD(net.parameters(), lr=0.01),
+                          metric=Accuracy(device),
+                          data_train_loader=loader,
+                          num_epoch=num_epoch,
+                          verbose=verbose,
+                          roor_dir=root_dir,
+                          createFolderByDate=False,
+                          enable_checkpointManager=False,
+                          device=device,
+                          sync_interval=sync_interval)
+        # 屏蔽打印，但保留格式化和输出的开销
+        with contextlib.redirect_stdout(io.StringIO()):
+            time_begin = time.perf_counter()
+            trainer.fit()
+            time_delta = time.perf_counter() - time_begin
+
+    return time_delta / (num_epoch*len(loader))
+
+
+if __name__ == '__main__':
+    settings = [
+        ('sync every step', dict(sync_interval=1, verbose=2)),
+        ('sync every 50 steps', dict(sync_interval=50, verbose=2)),
+        ('no batch output', dict(sync_interval=1, verbose=1)),
+    ]
+    baseline = None
+    for name, kwargs in settings:
+        step_time = run(**kwargs)
+        if baseline is None:
+            baseline = step_time
+        print('{:<22}{:>10.1f} us/step{:>10.2f}x'.format(
+            name, step_time*1e6, baseline/step_time))
@@ -0,0 +1,192 @@
+'''
+训练吞吐量测试
+在随机数据上，用Trainer把每个模型训练固定的步数，遍历不同的批大小和线程数
+记录吞吐量(样本/秒)、单步耗时的分位数和峰值内存，结果保存为JSON
+可以与保存的基准结果比较，超过阈值的退化会被标出
+    python -m kl.deepnet.benchmark.throughput --output result.json
+    python -m kl.deepnet.benchmark.throughput --baseline result.json
+'''
+from typing import Optional
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import torch as tc
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from ..model.resnet import ResNet, ResNetWithBottleNeck
+from ..nn import VGG
+from ..trainer import Trainer, Accuracy
+from ..trainer.util import peak_rss_mb
+from .util import run_isolated
+
+
+# 输入图像的通道数、高度和类别数
+C_IN = 3
+INPUT_HEIGHT = 64
+NUM_CLASS = 10
+
+# 测试的模型
+# 使用较小的宽度，使测试在普通CPU上也能较快完成
+MODELS = {
+    'resnet': lambda: ResNet(C_IN, NUM_CLASS, c_base=16),
+    'resnet_bottleneck': lambda: ResNetWithBottleNeck(
+        C_IN, NUM_CLASS, c_base=16, c_linear=16*32),
+    'vgg': lambda: VGG(C_IN, NUM_CLASS, c_base=16, fc_hid=512,
+                       input_height=INPUT_HEIGHT),
+}
+
+
+def run_one(model: str,
+            batch_size: int,
+            num_thread: int,
+            num_step: int = 20) -> dict:
+    '''
+    训练一个设置，应在独立的子进程中调用
+    训练两轮，第一轮用于预热，第二轮的结果作为测量值
+    '''
+    tc.set_num_threads(num_thread)
+    _ = tc.manual_seed(0)
+
+    net = MODELS[model]()
+    X = tc.randn(num_step*batch_size, C_IN, INPUT_HEIGHT, INPUT_HEIGHT)
+    Y = tc.randint(0, NUM_CLASS, (num_step*batch_size,))
+    loader = DataLoader(TensorDataset(X, Y), batch_size=batch_size)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        trainer = Trainer(net=net,
+                          loss_fn=nn.CrossEntropyLoss(),
+                          optimizer=tc.optim.SGD(net.parameters(), lr=0.01),
+                          metric=Accuracy(),
+                          data_train_loader=loader,
+                          num_epoch=2,
+                          verbose=0,
+                          roor_dir=root_dir,
+                          createFolderByDate=False,
+                          enable_checkpointManager=False,
+                          enable_timing=True)
+        trainer.fit()
+        info = trainer.summaryManager.storage[-1]
+
+    return {
+        'model': model,
+        'batch_size': batch_size,
+        'num_thread': num_thread,
+        'num_step': num_step,
+        'speed': info['speed'],
+        'step_p50_ms': info['time_step_p50'],
+        'step_p90_ms': info['time_step_p90'],
+        'step_p99_ms': info['time_step_p99'],
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_suite(models: list,
+              batch_sizes: list,
+              thread_counts: list,
+              num_step: int = 20) -> dict:
+    '''遍历所有设置，每个设置在新的子进程中执行'''
+    results = []
+    for model in models:
+        for batch_size in batch_sizes:
+            for num_thread in thread_counts:
+                result = run_isolated(run_one, model, batch_size, num_thread,
+                                      num_step=num_step)
+                print(format_row(result), flush=True)
+                results.append(result)
+    return {
+        'meta': {
+            'torch': tc.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def _key(result: dict) -> tuple:
+    return (result['model'], result['batch_size'], result['num_thread'])
+
+
+def compare(current: dict,
+            baseline: dict,
+            threshold: float = 0.1) -> list:
+    '''
+    与基准结果比较
+    吞吐量下降或单步耗时中位数上升超过threshold(比例)即视为退化
+    返回:
+        退化的设置列表
+    '''
+    base_results = {_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        base = base_results.get(_key(result), None)
+        if base is None:
+            continue
+        speed_ratio = result['speed'] / max(base['speed'], 1e-9)
+        latency_ratio = result['step_p50_ms'] / max(base['step_p50_ms'], 1e-9)
+        if speed_ratio < 1-threshold or latency_ratio > 1+threshold:
+            regressions.append({'model': result['model'],
+                                'batch_size': result['batch_size'],
+                                'num_thread': result['num_thread'],
+                                'speed_ratio': speed_ratio,
+                                'latency_ratio': latency_ratio})
+    return regressions
+
+
+def format_row(result: dict) -> str:
+    return '{:<18}{:>6}{:>8}{:>14.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>12.1f}'.format(
+        result['model'], result['batch_size'], result['num_thread'],
+        result['speed'], result['step_p50_ms'], result['step_p90_ms'],
+        result['step_p99_ms'], result['peak_rss_mb'])
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--models', nargs='+', default=list(MODELS),
+                        choices=list(MODELS))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[8, 32])
+    parser.add_argument('--threads', nargs='+', type=int,
+                        default=sorted({1, tc.get_num_threads()}))
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--output', default=None,
+                        help='结果保存的JSON路径')
+    parser.add_argument('--baseline', default=None,
+                        help='用于比较的基准结果JSON路径')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='视为退化的相对变化')
+    args = parser.parse_args(argv)
+
+    print('{:<18}{:>6}{:>8}{:>14}{:>10}{:>10}{:>10}{:>12}'.format(
+        'model', 'batch', 'thread', 'samples/s', 'p50(ms)', 'p90(ms)',
+        'p99(ms)', 'RSS(MB)'))
+    current = run_suite(args.models, args.batch_sizes, args.threads,
+                        num_step=args.steps)
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(current, fp=fp, indent=4, ensure_ascii=False)
+
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as fp:
+        baseline = json.load(fp=fp)
+    regressions = compare(current, baseline, threshold=args.threshold)
+    for item in regressions:
+        print('REGRESSION {model} batch={batch_size} thread={num_thread}: '
+              'speed x{speed_ratio:.2f}, p50 x{latency_ratio:.2f}'.format(**item))
+    if len(regressions) == 0:
+        print(f'No regression beyond {args.threshold:.0%}.')
+    # 有退化时返回非0，便于在CI中使用
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
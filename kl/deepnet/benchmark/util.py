@@ -0,0 +1,12 @@
+import multiprocessing
+
+
+def run_isolated(fn, *args, **kwargs):
+    '''
+    在新的子进程中执行函数并返回结果
+    每次测量的峰值内存互不影响
+    fn必须定义在模块顶层
+    '''
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=1) as pool:
+        return pool.apply(fn, args=args, kwds=kwargs)
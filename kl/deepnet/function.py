@@ -1,25 +1,110 @@
+import contextlib
+import math
+
 import torch as tc
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
 
+# 是否有融合的注意力实现
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
 
-def dot_attention(Q, K, V, return_attention=False):
-    '''点积注意力'''
-    # 词向量长度
-    d = tc.tensor(K.shape[-1])
-    # 在(b,s,w)的(s,w)部分转置
-    K_T = K.transpose(-1, -2).contiguous()
-    # 注意力分布
-    A_ = Q@K_T/tc.sqrt(d)
-    # 归一化
-    A = tc.softmax(A_, dim=-1)
-    # 查询结果
-    Y = A@V
 
+def dot_attention(Q, K, V, return_attention=False,
+                  mask=None, is_causal=False,
+                  query_chunk_size=1024, key_chunk_size=1024):
+    '''
+    点积注意力
+    优先使用融合的scaled_dot_product_attention，不可用时按块计算(参见chunked_attention)
+    两者都不保存完整的注意力分数矩阵
+    参数:
+        Q, K, V  形状为(..., s, w)
+        return_attention  是否同时返回注意力分布，此时需要计算完整的矩阵
+        mask  可广播到(..., s_q, s_k)
+            布尔值时True表示保留，浮点数时加到注意力分数上
+        is_causal  因果掩码，第i个查询只关注前i个键
+    '''
+    scale = 1 / math.sqrt(Q.shape[-1])
     if return_attention:
         # 顺便返回注意力分布
-        return Y, A
-    else:
-        return Y
+        A = tc.softmax(_mask_scores((Q*scale)@K.transpose(-1, -2),
+                                    mask, is_causal, 0, 0), dim=-1)
+        return A@V, A
+    if _HAS_SDPA and not (mask is not None and is_causal):
+        # SDPA不能同时指定mask和is_causal
+        return F.scaled_dot_product_attention(Q, K, V, attn_mask=mask,
+                                              is_causal=is_causal)
+    return chunked_attention(Q, K, V, mask=mask, is_causal=is_causal,
+                             query_chunk_size=query_chunk_size,
+                             key_chunk_size=key_chunk_size)
+
+
+def _mask_scores(S, mask, is_causal: bool, q_begin: int, k_begin: int):
+    '''
+    对注意力分数的一块应用掩码
+    参数:
+        q_begin, k_begin  该块的查询和键在完整矩阵中的起始位置
+    '''
+    s_q, s_k = S.shape[-2], S.shape[-1]
+    if is_causal:
+        q_idx = tc.arange(q_begin, q_begin+s_q, device=S.device)
+        k_idx = tc.arange(k_begin, k_begin+s_k, device=S.device)
+        S = S.masked_fill(k_idx[None, :] > q_idx[:, None], float('-inf'))
+    if mask is not None:
+        # 长度为1的维度保持广播
+        if mask.dim() >= 2 and mask.shape[-2] != 1:
+            mask = mask[..., q_begin:q_begin+s_q, :]
+        if mask.shape[-1] != 1:
+            mask = mask[..., k_begin:k_begin+s_k]
+        if mask.dtype == tc.bool:
+            S = S.masked_fill(~mask, float('-inf'))
+        else:
+            S = S + mask
+    return S
+
+
+def chunked_attention(Q, K, V, mask=None, is_causal=False,
+                      query_chunk_size=1024, key_chunk_size=1024):
+    '''
+    分块计算的点积注意力
+    查询和键都按块遍历，用在线softmax累积每块的结果
+    内存占用为O(query_chunk_size*key_chunk_size)，而不是O(s_q*s_k)
+    半精度输入时在float32中累积
+    参数同dot_attention
+    '''
+    scale = 1 / math.sqrt(Q.shape[-1])
+    s_q, s_k = Q.shape[-2], K.shape[-2]
+    dtype = tc.float32 if Q.dtype in (tc.float16, tc.bfloat16) else Q.dtype
+
+    outputs = []
+    for q_begin in range(0, s_q, query_chunk_size):
+        q = Q[..., q_begin:q_begin+query_chunk_size, :].to(dtype) * scale
+        q_end = q_begin + q.shape[-2]
+        # 当前的最大分数、softmax的分母和加权和
+        m = tc.full(q.shape[:-1]+(1,), float('-inf'), dtype=dtype, device=Q.device)
+        l = tc.zeros_like(m)
+        acc = tc.zeros(q.shape[:-1]+(V.shape[-1],), dtype=dtype, device=Q.device)
+        for k_begin in range(0, s_k, key_chunk_size):
+            if is_causal and k_begin >= q_end:
+                # 之后的键都被因果掩码遮住
+                break
+            k = K[..., k_begin:k_begin+key_chunk_size, :].to(dtype)
+            v = V[..., k_begin:k_begin+key_chunk_size, :].to(dtype)
+            S = _mask_scores(q@k.transpose(-1, -2), mask, is_causal,
+                             q_begin, k_begin)
+
+            m_new = tc.maximum(m, S.amax(dim=-1, keepdim=True))
+            # 整行都被遮住时最大值为-inf，避免inf-inf
+            m_safe = tc.where(tc.isinf(m_new), tc.zeros_like(m_new), m_new)
+            P = tc.exp(S - m_safe)
+            # 按新的最大值缩放之前的累积值
+            correction = tc.exp(m - m_safe)
+            l = l*correction + P.sum(dim=-1, keepdim=True)
+            acc = acc*correction + P@v
+            m = m_new
+        outputs.append((acc / l).to(Q.dtype))
+    return tc.cat(outputs, dim=-2)
 
 
 def init_normal(net, seed=0):
@@ -27,3 +112,69 @@ def init_normal(net, seed=0):
     for param in net.parameters():
         _ = tc.random.manual_seed(seed)
         _ = nn.init.normal_(param.data, mean=0, std=1)
+
+
+def parse_checkpoint_stages(checkpoint_stages, num_stage: int) -> list:
+    '''
+    整理需要使用激活检查点的阶段序号
+    参数:
+        checkpoint_stages  None(不使用)、'all'(全部)或序号的列表
+    '''
+    if checkpoint_stages is None:
+        return []
+    if checkpoint_stages == 'all':
+        return list(range(num_stage))
+    stages = sorted(set(checkpoint_stages))
+    for idx in stages:
+        if not 0 <= idx < num_stage:
+            raise ValueError(
+                f'Stage index {idx} out of range, there are {num_stage} stages.')
+    return stages
+
+
+@contextlib.contextmanager
+def _restore_batchnorm_stats(module: nn.Module):
+    '''退出时把BatchNorm的统计量恢复为进入时的值'''
+    bns = [m for m in module.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [{name: buffer.clone()
+              for name, buffer in bn.named_buffers(recurse=False)}
+             for bn in bns]
+    try:
+        yield
+    finally:
+        with tc.no_grad():
+            for bn, buffers in zip(bns, saved):
+                for name, value in buffers.items():
+                    getattr(bn, name).copy_(value)
+
+
+def forward_with_checkpoint(stages: nn.Sequential, X,
+                            checkpoint_stages: list = None,
+                            num_segment: int = 1):
+    '''
+    依次执行每个阶段，对指定的阶段使用激活检查点
+    这些阶段在前向时只保存每段的输入，反向时重新计算段内的激活值，以计算时间换内存
+    只在训练且需要梯度时生效，测试和推理时与普通的前向计算相同
+    重新计算时BatchNorm对统计量的更新会被撤销，与不使用检查点时一致
+    参数:
+        checkpoint_stages  使用激活检查点的阶段序号，None表示不使用
+        num_segment  每个阶段分为几段，每段单独检查点
+            1表示整个阶段为一段，保存的激活最少；不小于阶段的层数时每层为一段
+    '''
+    checkpoint_stages = checkpoint_stages or []
+    use_checkpoint = stages.training and tc.is_grad_enabled()
+    for idx, stage in enumerate(stages):
+        if not use_checkpoint or idx not in checkpoint_stages:
+            X = stage(X)
+            continue
+        layers = list(stage) if isinstance(stage, nn.Sequential) else [stage]
+        # 每段的层数
+        segment_size = -(-len(layers) // max(min(num_segment, len(layers)), 1))
+        for begin in range(0, len(layers), segment_size):
+            segment = nn.Sequential(*layers[begin:begin+segment_size])
+            X = checkpoint(
+                segment, X, use_reentrant=False,
+                context_fn=lambda segment=segment: (
+                    contextlib.nullcontext(), _restore_batchnorm_stats(segment)))
+    return X
@@ -4,6 +4,8 @@ import torch.nn.functional as F
 
 from torchvision import models
 
+from ..function import parse_checkpoint_stages, forward_with_checkpoint
+
 
 def sampleForRes(c_in, c_out, stride=1):
     '''
@@ -98,7 +100,16 @@ class ResNet(nn.Module):
     def __init__(self, c_in, c_out,
                  c_base=64,
                  c_linear=512,
-                 num_layers=[2, 2, 2, 2]):
+                 num_layers=[2, 2, 2, 2],
+                 checkpoint_stages=None,
+                 checkpoint_segments=1):
+        '''
+        参数:
+            checkpoint_stages  对mainBlock中的哪些阶段(0~3)使用激活检查点
+                None不使用，'all'全部使用
+                反向时重新计算这些阶段的激活值，减少训练时的内存占用
+            checkpoint_segments  每个阶段分为几段检查点，参见forward_with_checkpoint
+        '''
         super().__init__()
         self.c_in = c_in
         self.c_out = c_out
@@ -107,6 +118,11 @@ class ResNet(nn.Module):
         self.num_layers = num_layers
         self.c_linear = c_linear
 
+        # 激活检查点
+        self.checkpoint_stages = parse_checkpoint_stages(
+            checkpoint_stages, len(num_layers))
+        self.checkpoint_segments = checkpoint_segments
+
         # 生成网络
         self.build()
 
@@ -165,7 +181,9 @@ class ResNet(nn.Module):
 
     def forward(self, X):
         Y = self.inputBlock(X)
-        Y = self.mainBlock(Y)
+        Y = forward_with_checkpoint(self.mainBlock, Y,
+                                    self.checkpoint_stages,
+                                    self.checkpoint_segments)
         return self.outputBlock(Y)
 
 
@@ -175,7 +193,15 @@ class ResNetWithBottleNeck(nn.Module):
     def __init__(self, c_in, c_out,
                  c_base=64,
                  num_layers=[3, 4, 6, 3],
-                 c_linear=512):
+                 c_linear=512,
+                 checkpoint_stages=None,
+                 checkpoint_segments=1):
+        '''
+        参数:
+            checkpoint_stages  对mainBlock中的哪些阶段(0~3)使用激活检查点
+                None不使用，'all'全部使用
+            checkpoint_segments  每个阶段分为几段检查点，参见forward_with_checkpoint
+        '''
         super().__init__()
         self.c_in = c_in
         self.c_out = c_out
@@ -185,6 +211,11 @@ class ResNetWithBottleNeck(nn.Module):
         # 全连接层的特征数
         self.c_linear = c_linear
 
+        # 激活检查点
+        self.checkpoint_stages = parse_checkpoint_stages(
+            checkpoint_stages, len(num_layers))
+        self.checkpoint_segments = checkpoint_segments
+
         # 生成网络
         self.build()
 
@@ -243,5 +274,7 @@ class ResNetWithBottleNeck(nn.Module):
 
     def forward(self, X):
         Y = self.inputBlock(X)
-        Y = self.mainBlock(Y)
+        Y = forward_with_checkpoint(self.mainBlock, Y,
+                                    self.checkpoint_stages,
+                                    self.checkpoint_segments)
         return self.outputBlock(Y)
@@ -1,9 +1,21 @@
+from typing import Optional, Union
+
+import torch as tc
 import torch.nn as nn
 
+from .function import parse_checkpoint_stages, forward_with_checkpoint, dot_attention
+
 
 class VGG(nn.Module):
     def __init__(self, c_in, c_out, c_base=64, fc_hid=4096, input_height=224,
-                 dropout_rate=0.1):
+                 dropout_rate=0.1, checkpoint_stages=None, checkpoint_segments=1):
+        '''
+        参数:
+            checkpoint_stages  对convAll中的哪些VGG块(0~4)使用激活检查点
+                None不使用，'all'全部使用
+                反向时重新计算这些块的激活值，减少训练时的内存占用
+            checkpoint_segments  每个块分为几段检查点，参见forward_with_checkpoint
+        '''
         super().__init__()
         # 输入通道数
         self.c_in = c_in
@@ -16,6 +28,9 @@ class VGG(nn.Module):
         # 输入单个样本的高度
         self.input_height = input_height
         self.dropout_rate = dropout_rate
+        # 激活检查点
+        self.checkpoint_stages = parse_checkpoint_stages(checkpoint_stages, 5)
+        self.checkpoint_segments = checkpoint_segments
 
         # 创建网络
         self.build()
@@ -76,5 +91,168 @@ class VGG(nn.Module):
         return seq
 
     def forward(self, X):
-        Y = self.convAll(X)
+        Y = forward_with_checkpoint(self.convAll, X,
+                                    self.checkpoint_stages,
+                                    self.checkpoint_segments)
         return self.threeLinear(Y)
+
+
+class MultiHeadAttention(nn.Module):
+    '''
+    多头自注意力
+    forward对整个序列计算，用于训练
+    自回归生成时使用键值缓存:
+        allocate_cache  预先分配num_slot个序列的缓存，每个槽位存放一个序列
+        prefill  计算提示部分，写入缓存
+        step  每步只计算新位置的查询、键、值，与缓存中的键值做注意力
+    不同槽位的序列长度可以不同，可以同时生成多个序列
+    '''
+
+    def __init__(self, d_model: int, num_head: int = 8, bias: bool = True):
+        super().__init__()
+        if d_model % num_head != 0:
+            raise ValueError(
+                f'd_model {d_model} should be divisible by num_head {num_head}.')
+        self.d_model = d_model
+        self.num_head = num_head
+        # 每个头的维度
+        self.d_head = d_model // num_head
+
+        # 查询、键、值的投影合并为一个线性层
+        self.W_qkv = nn.Linear(d_model, d_model*3, bias=bias)
+        self.W_o = nn.Linear(d_model, d_model, bias=bias)
+
+        # 键值缓存，由allocate_cache分配
+        self.cache_k = None
+        self.cache_v = None
+        # 每个槽位已缓存的长度，保存在CPU上，检查长度时不需要设备同步
+        self.cache_lengths = None
+
+    def _split_heads(self, X):
+        '''(b,s,d) -> (b,h,s,d_head)'''
+        b, s, _ = X.shape
+        return X.view(b, s, self.num_head, self.d_head).transpose(1, 2)
+
+    def _merge_heads(self, X):
+        '''(b,h,s,d_head) -> (b,s,d)'''
+        b, _, s, _ = X.shape
+        return X.transpose(1, 2).reshape(b, s, self.d_model)
+
+    def _qkv(self, X):
+        Q, K, V = self.W_qkv(X).chunk(3, dim=-1)
+        return self._split_heads(Q), self._split_heads(K), self._split_heads(V)
+
+    def forward(self, X, mask=None, is_causal: bool = False):
+        '''
+        参数:
+            X  形状为(b,s,d_model)
+            mask, is_causal  参见dot_attention
+        '''
+        Q, K, V = self._qkv(X)
+        Y = dot_attention(Q, K, V, mask=mask, is_causal=is_causal)
+        return self.W_o(self._merge_heads(Y))
+
+    def allocate_cache(self, num_slot: int, max_length: int,
+                       device: Union[str, tc.device, None] = None,
+                       dtype: Optional[tc.dtype] = None) -> None:
+        '''
+        预先分配键值缓存，之后生成时不再分配内存
+        参数:
+            num_slot  槽位数量，即可以同时生成的序列数
+            max_length  每个序列的最大长度(包括提示)
+        '''
+        weight = self.W_qkv.weight
+        shape = (num_slot, self.num_head, max_length, self.d_head)
+        self.cache_k = tc.zeros(shape, device=device or weight.device,
+                                dtype=dtype or weight.dtype)
+        self.cache_v = tc.zeros_like(self.cache_k)
+        self.cache_lengths = tc.zeros(num_slot, dtype=tc.long)
+
+    def free_cache(self) -> None:
+        self.cache_k = self.cache_v = self.cache_lengths = None
+
+    def reset_cache(self, slots=None) -> None:
+        '''清空指定槽位(默认全部)，槽位可以用于新的序列'''
+        if slots is None:
+            self.cache_lengths.zero_()
+        else:
+            self.cache_lengths[tc.as_tensor(slots, dtype=tc.long)] = 0
+
+    def _get_slots(self, slots, batch_size: int) -> tc.Tensor:
+        if self.cache_k is None:
+            raise RuntimeError('Call allocate_cache before using the cache.')
+        if slots is None:
+            slots = tc.arange(batch_size)
+        slots = tc.as_tensor(slots, dtype=tc.long)
+        if len(slots) != batch_size:
+            raise ValueError(
+                f'Got {len(slots)} slots for a batch of {batch_size}.')
+        return slots
+
+    def prefill(self, X, slots=None):
+        '''
+        计算提示部分(因果注意力)，并把键值写入缓存
+        参数:
+            X  形状为(b,s,d_model)，同一批的提示长度相同
+            slots  每个序列使用的槽位，默认为0~b-1
+        返回:
+            提示部分的输出，形状为(b,s,d_model)
+        '''
+        b, s, _ = X.shape
+        slots = self._get_slots(slots, b)
+        if s > self.cache_k.shape[2]:
+            raise ValueError(
+                f'Prompt length {s} exceeds cache length {self.cache_k.shape[2]}.')
+        Q, K, V = self._qkv(X)
+        slots_device = slots.to(self.cache_k.device)
+        self.cache_k[slots_device, :, :s] = K.to(self.cache_k.dtype)
+        self.cache_v[slots_device, :, :s] = V.to(self.cache_v.dtype)
+        self.cache_lengths[slots] = s
+        Y = dot_attention(Q, K, V, is_causal=True)
+        return self.W_o(self._merge_heads(Y))
+
+    def step(self, X, slots=None):
+        '''
+        生成一步，每个序列只输入一个新位置
+        只计算新位置的查询、键、值，键值写入缓存后与之前的所有位置做注意力
+        参数:
+            X  形状为(b,d_model)或(b,1,d_model)
+            slots  每个序列使用的槽位，默认为0~b-1
+        返回:
+            新位置的输出，形状与X相同
+        '''
+        squeeze = X.dim() == 2
+        if squeeze:
+            X = X.unsqueeze(1)
+        b = X.shape[0]
+        slots = self._get_slots(slots, b)
+        lengths = self.cache_lengths[slots]
+        max_length = self.cache_k.shape[2]
+        if int(lengths.max()) >= max_length:
+            raise ValueError(f'KV cache is full (max_length={max_length}).')
+
+        # (b,h,1,d_head)
+        Q, K, V = self._qkv(X)
+        device = self.cache_k.device
+        slots_device = slots.to(device, non_blocking=True)
+        positions = lengths.to(device, non_blocking=True)
+        # 写入新位置的键值
+        self.cache_k[slots_device, :, positions] = K[:, :, 0].to(self.cache_k.dtype)
+        self.cache_v[slots_device, :, positions] = V[:, :, 0].to(self.cache_v.dtype)
+        self.cache_lengths[slots] = lengths + 1
+
+        # 只取到本批最长的序列
+        num_key = int(lengths.max()) + 1
+        if tc.equal(slots, tc.arange(b)):
+            # 槽位连续时直接切片，不复制
+            K_all = self.cache_k[:b, :, :num_key]
+            V_all = self.cache_v[:b, :, :num_key]
+        else:
+            K_all = self.cache_k[slots_device, :, :num_key]
+            V_all = self.cache_v[slots_device, :, :num_key]
+        # 遮住各序列自身长度之后的位置
+        mask = tc.arange(num_key, device=device)[None, :] <= positions[:, None]
+        Y = dot_attention(Q, K_all.to(Q.dtype), V_all.to(Q.dtype),
+                          mask=mask[:, None, None, :])
+        Y = self.W_o(self._merge_heads(Y))
+        return Y.squeeze(1) if squeeze else Y
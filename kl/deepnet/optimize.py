@@ -0,0 +1,260 @@
+'''
+推理优化
+    1. 把BatchNorm折叠进前面的卷积
+    2. 可选地用TorchScript冻结并优化，融合卷积与ReLU等相邻的算子
+    3. 网络和输入转为channels_last内存格式
+优化后与原网络比较输出，并测量批大小为1和64时的延迟
+    python -m kl.deepnet.optimize
+'''
+from typing import Optional
+import argparse
+import collections
+import copy
+import statistics
+import time
+
+import torch as tc
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from .trainer.batch_finder import take_rows
+
+
+def _can_fold(conv, bn) -> bool:
+    return isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) \
+        and bn.track_running_stats and bn.num_features == conv.out_channels
+
+
+def _traced_pairs(net: nn.Module) -> list:
+    '''
+    用torch.fx追踪计算图，找出输出只被BatchNorm使用的卷积
+    卷积和BatchNorm都只被调用一次时才可以折叠
+    返回:
+        (卷积的模块名, BatchNorm的模块名)的列表
+    '''
+    graph = tc.fx.symbolic_trace(net).graph
+    modules = dict(net.named_modules())
+    num_call = collections.Counter(node.target for node in graph.nodes
+                                   if node.op == 'call_module')
+    pairs = []
+    for node in graph.nodes:
+        if node.op != 'call_module' or len(node.args) != 1:
+            continue
+        conv_node = node.args[0]
+        if not isinstance(conv_node, tc.fx.Node) or conv_node.op != 'call_module' \
+                or len(conv_node.users) != 1:
+            continue
+        if num_call[node.target] == 1 and num_call[conv_node.target] == 1 \
+                and _can_fold(modules[conv_node.target], modules[node.target]):
+            pairs.append((conv_node.target, node.target))
+    return pairs
+
+
+def _sequential_pairs(net: nn.Module) -> list:
+    '''Sequential中相邻的Conv2d和BatchNorm2d'''
+    pairs = []
+    for module_name, module in net.named_modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        prefix = module_name + '.' if module_name else ''
+        children = list(module.named_children())
+        for (name, child), (next_name, next_child) in zip(children[:-1], children[1:]):
+            if _can_fold(child, next_child):
+                pairs.append((prefix+name, prefix+next_name))
+    return pairs
+
+
+def _set_module(net: nn.Module, name: str, module: nn.Module) -> None:
+    parent_name, _, attr = name.rpartition('.')
+    setattr(net.get_submodule(parent_name) if parent_name else net, attr, module)
+
+
+def fold_batchnorm(net: nn.Module) -> int:
+    '''
+    把BatchNorm折叠进前面的卷积，原地修改，网络应处于eval模式
+    用torch.fx追踪计算图，只折叠BatchNorm直接作用于卷积输出、且卷积输出没有其他用途的情况
+    例如conv2dBN、DoubleConvRes、Bottleneck和torchvision的残差块
+    追踪失败时(例如forward中有依赖数据的控制流)只折叠Sequential中相邻的Conv2d和BatchNorm2d
+    被折叠的BatchNorm替换为Identity
+    返回:
+        折叠的数量
+    '''
+    try:
+        pairs = _traced_pairs(net)
+    except Exception:
+        pairs = _sequential_pairs(net)
+    for conv_name, bn_name in pairs:
+        _set_module(net, conv_name, fuse_conv_bn_eval(net.get_submodule(conv_name),
+                                                      net.get_submodule(bn_name)))
+        _set_module(net, bn_name, nn.Identity())
+    return len(pairs)
+
+
+class ChannelsLast(nn.Module):
+    '''把4维输入转为channels_last格式后再计算'''
+
+    def __init__(self, net: nn.Module):
+        super().__init__()
+        self.net = net.to(memory_format=tc.channels_last)
+
+    def forward(self, X):
+        if X.dim() == 4:
+            X = X.contiguous(memory_format=tc.channels_last)
+        return self.net(X)
+
+
+def freeze(net: nn.Module, example_input: tc.Tensor) -> nn.Module:
+    '''
+    用TorchScript追踪并冻结网络
+    冻结后权重成为常量，optimize_for_inference会融合卷积与ReLU、加法等算子
+    '''
+    with tc.no_grad():
+        traced = tc.jit.trace(net, example_input)
+    traced = tc.jit.freeze(traced.eval())
+    return tc.jit.optimize_for_inference(traced)
+
+
+def check_equivalence(reference: nn.Module,
+                      optimized: nn.Module,
+                      X: tc.Tensor,
+                      rtol: float = 1e-3,
+                      atol: float = 1e-4) -> float:
+    '''
+    比较两个网络的输出，超出容差时抛出异常
+    返回:
+        最大绝对误差
+    '''
+    with tc.inference_mode():
+        Y_ref = reference(X)
+        Y = optimized(X)
+    error = (Y.float() - Y_ref.float()).abs().max().item()
+    if not tc.allclose(Y.float(), Y_ref.float(), rtol=rtol, atol=atol):
+        raise RuntimeError(
+            f'Optimized network differs from the original, max abs error {error:.3g}.')
+    return error
+
+
+def measure_latency(net: nn.Module,
+                    X: tc.Tensor,
+                    num_repeat: int = 20,
+                    num_warmup: int = 3) -> float:
+    '''前向计算的延迟中位数(毫秒)'''
+    is_cuda = X.device.type == 'cuda'
+    times = []
+    with tc.inference_mode():
+        for idx in range(num_warmup+num_repeat):
+            if is_cuda:
+                tc.cuda.synchronize(X.device)
+            time_begin = time.perf_counter()
+            _ = net(X)
+            if is_cuda:
+                tc.cuda.synchronize(X.device)
+            if idx >= num_warmup:
+                times.append(time.perf_counter() - time_begin)
+    return statistics.median(times) * 1e3
+
+
+def optimize_for_inference(net: nn.Module,
+                           example_input: tc.Tensor,
+                           fold_bn: bool = True,
+                           channels_last: bool = True,
+                           use_jit: bool = False,
+                           rtol: float = 1e-3,
+                           atol: float = 1e-4,
+                           batch_sizes: Optional[tuple] = (1, 64),
+                           verbose: int = 1) -> tuple:
+    '''
+    推理优化，不修改原网络
+    参数:
+        example_input  一个批的输入，用于追踪、检查输出和测量延迟
+        fold_bn  是否把BatchNorm折叠进卷积
+        channels_last  是否使用channels_last内存格式
+        use_jit  是否用TorchScript冻结并融合算子(包括卷积+ReLU)，失败时跳过
+        batch_sizes  测量延迟的批大小，None表示不测量
+    返回:
+        优化后的网络和报告
+        报告为{'num_fold', 'jit', 'max_abs_error', 'latency'}
+        latency为每个批大小优化前后的延迟(毫秒)和加速比
+    '''
+    is_training = net.training
+    try:
+        return _optimize(net, example_input, fold_bn, channels_last, use_jit,
+                         rtol, atol, batch_sizes, verbose)
+    finally:
+        net.train(is_training)
+
+
+def _optimize(net, example_input, fold_bn, channels_last, use_jit,
+              rtol, atol, batch_sizes, verbose) -> tuple:
+    reference = net.eval()
+    optimized = copy.deepcopy(net).eval()
+    report = {'num_fold': 0, 'jit': False}
+
+    if fold_bn:
+        report['num_fold'] = fold_batchnorm(optimized)
+    if channels_last:
+        optimized = ChannelsLast(optimized)
+    if use_jit:
+        X = example_input.contiguous(memory_format=tc.channels_last) \
+            if channels_last and example_input.dim() == 4 else example_input
+        try:
+            optimized = freeze(optimized, X)
+            report['jit'] = True
+        except Exception as error:
+            if verbose >= 1:
+                print(f'TorchScript freeze failed, skipped: {error}')
+
+    report['max_abs_error'] = check_equivalence(
+        reference, optimized, example_input, rtol=rtol, atol=atol)
+
+    report['latency'] = {}
+    for batch_size in batch_sizes or []:
+        X = take_rows(example_input, batch_size)
+        latency_before = measure_latency(reference, X)
+        latency_after = measure_latency(optimized, X)
+        report['latency'][batch_size] = {
+            'before_ms': latency_before,
+            'after_ms': latency_after,
+            'speedup': latency_before / max(latency_after, 1e-9),
+        }
+        if verbose >= 1:
+            print('Batch Size:{}, Before:{:.3f}ms, After:{:.3f}ms, Speedup:{:.2f}x'.format(
+                batch_size, latency_before, latency_after,
+                report['latency'][batch_size]['speedup']))
+    return optimized, report
+
+
+def main(argv=None) -> None:
+    from .model.resnet import ResNet, ResNetWithBottleNeck
+    from .nn import VGG
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input-height', type=int, default=64)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--jit', action='store_true',
+                        help='用TorchScript冻结并融合算子')
+    args = parser.parse_args(argv)
+
+    models = {
+        'resnet': lambda: ResNet(3, 10, c_base=32),
+        'resnet_bottleneck': lambda: ResNetWithBottleNeck(3, 10, c_base=16,
+                                                          c_linear=16*32),
+        'vgg': lambda: VGG(3, 10, c_base=16, fc_hid=512,
+                           input_height=args.input_height),
+    }
+    X = tc.randn(1, 3, args.input_height, args.input_height, device=args.device)
+    for name, build in models.items():
+        _ = tc.manual_seed(0)
+        net = build().to(args.device)
+        # 随机初始化的BatchNorm统计量是0和1，先用训练模式更新一次，使折叠有意义
+        with tc.no_grad():
+            _ = net.train()(tc.randn(8, *X.shape[1:], device=args.device))
+        print(f'========{name}========')
+        _, report = optimize_for_inference(net, X, use_jit=args.jit)
+        print('Folded BatchNorm:{}, Max Abs Error:{:.3g}'.format(
+            report['num_fold'], report['max_abs_error']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+'''
+训练后int8量化(CPU推理)
+    dynamic  动态量化，只量化Linear层的权重，激活值在运行时量化，不需要校准
+    static  静态量化(FX图模式)，用校准数据统计激活值的范围，卷积、BatchNorm、ReLU会被融合
+        默认Linear层仍使用动态量化，全连接头的激活值范围变化大时精度更好
+与fp32网络比较精度、模型大小和延迟:
+    python -m kl.deepnet.quantize --model vgg --checkpoint ./trainer_output/checkpoint
+不指定权重时使用随机初始化的网络和随机数据，只用于检查流程
+'''
+from typing import Optional
+import argparse
+import copy
+import io
+
+import torch as tc
+import torch.nn as nn
+import torch.ao.nn.intrinsic as nni
+from torch.ao.quantization import QConfigMapping, get_default_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .optimize import measure_latency
+from .trainer.metric import Accuracy
+
+
+def select_engine(engine: Optional[str] = None) -> str:
+    '''选择量化计算的后端，默认依次尝试x86、fbgemm、qnnpack'''
+    supported = tc.backends.quantized.supported_engines
+    candidates = [engine] if engine is not None else ['x86', 'fbgemm', 'qnnpack']
+    for candidate in candidates:
+        if candidate in supported:
+            tc.backends.quantized.engine = candidate
+            return candidate
+    raise RuntimeError(
+        f'Quantized engine {candidates} not supported, available: {supported}.')
+
+
+def quantize_dynamic_linear(net: nn.Module) -> nn.Module:
+    '''动态量化所有Linear层，不修改原网络'''
+    net = copy.deepcopy(net).cpu().eval()
+    return quantize_dynamic(net, {nn.Linear}, dtype=tc.qint8)
+
+
+def quantize_static(net: nn.Module,
+                    calibration_loader,
+                    num_calibration_batch: int = 32,
+                    dynamic_linear: bool = True,
+                    engine: Optional[str] = None) -> nn.Module:
+    '''
+    FX图模式的静态量化，不修改原网络
+    参数:
+        calibration_loader  校准数据，每个批的第一项是输入
+        num_calibration_batch  校准使用的批数量
+        dynamic_linear  Linear层是否使用动态量化
+            Linear层(及紧跟的ReLU)不参与静态量化，转换后再动态量化
+    '''
+    engine = select_engine(engine)
+    net = copy.deepcopy(net).cpu().eval()
+    qconfig_mapping = QConfigMapping().set_global(get_default_qconfig(engine))
+    if dynamic_linear:
+        # Linear和之后的ReLU会被融合为LinearReLU，两者的配置必须一致
+        # 静态转换时都保留为浮点数，转换后再动态量化
+        for name in _linear_head_names(net):
+            qconfig_mapping = qconfig_mapping.set_module_name(name, None)
+
+    data_iter = iter(calibration_loader)
+    example = _get_input(next(data_iter))
+    prepared = prepare_fx(net, qconfig_mapping, example_inputs=(example,))
+    # 校准，统计激活值的范围
+    with tc.inference_mode():
+        _ = prepared(example)
+        for _, data in zip(range(num_calibration_batch-1), data_iter):
+            _ = prepared(_get_input(data))
+    qnet = convert_fx(prepared)
+    if dynamic_linear:
+        qnet = quantize_dynamic(qnet, {nn.Linear, nni.LinearReLU}, dtype=tc.qint8)
+    return qnet
+
+
+def _linear_head_names(net: nn.Module) -> list:
+    '''所有Linear层，以及Sequential中紧跟在Linear之后的ReLU的名称'''
+    names = []
+    for module_name, module in net.named_modules():
+        prefix = module_name + '.' if module_name else ''
+        children = list(module.named_children())
+        for idx, (name, child) in enumerate(children):
+            if not isinstance(child, nn.Linear):
+                continue
+            names.append(prefix + name)
+            if isinstance(module, nn.Sequential) and idx+1 < len(children) \
+                    and isinstance(children[idx+1][1], nn.ReLU):
+                names.append(prefix + children[idx+1][0])
+    return names
+
+
+def _get_input(data) -> tc.Tensor:
+    X = data[0] if isinstance(data, (list, tuple)) else data
+    return X.cpu()
+
+
+def evaluate(net: nn.Module, data_loader) -> float:
+    '''在CPU上计算分类精度'''
+    metric = Accuracy()
+    net.eval()
+    with tc.inference_mode():
+        for X, Y_true in data_loader:
+            metric.update(net(X.cpu()), Y_true.cpu())
+    return metric.compute().item()
+
+
+def model_size_mb(net: nn.Module) -> float:
+    '''序列化后的权重大小(MB)'''
+    buffer = io.BytesIO()
+    tc.save(net.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1024**2
+
+
+def quantization_report(net: nn.Module,
+                        calibration_loader,
+                        eval_loader,
+                        modes: tuple = ('dynamic', 'static'),
+                        num_calibration_batch: int = 32,
+                        engine: Optional[str] = None,
+                        verbose: int = 1) -> tuple:
+    '''
+    量化网络，并与fp32网络比较
+    参数:
+        modes  量化方式，dynamic或static
+        eval_loader  用于比较精度的数据，第一个批也用于测量延迟
+    返回:
+        “量化方式-量化后的网络”的字典，以及报表
+        报表的每一行为{'mode', 'accuracy', 'accuracy_delta', 'size_mb', 'latency_ms'}
+        latency_ms为批大小为1和eval_loader的批大小时的延迟
+    '''
+    _ = select_engine(engine)
+    net = copy.deepcopy(net).cpu().eval()
+    nets = {'fp32': net}
+    for mode in modes:
+        if mode == 'dynamic':
+            nets[mode] = quantize_dynamic_linear(net)
+        elif mode == 'static':
+            nets[mode] = quantize_static(net, calibration_loader,
+                                         num_calibration_batch=num_calibration_batch,
+                                         engine=engine)
+        else:
+            raise ValueError(f'Unknown quantization mode "{mode}".')
+
+    X = _get_input(next(iter(eval_loader)))
+    rows = []
+    for mode, qnet in nets.items():
+        accuracy = evaluate(qnet, eval_loader)
+        rows.append({
+            'mode': mode,
+            'accuracy': accuracy,
+            'accuracy_delta': accuracy - rows[0]['accuracy'] if len(rows) > 0 else 0.0,
+            'size_mb': model_size_mb(qnet),
+            'latency_ms': {1: measure_latency(qnet, X[:1]),
+                           len(X): measure_latency(qnet, X)},
+        })
+
+    if verbose >= 1:
+        print(format_report(rows))
+    return nets, rows
+
+
+def format_report(rows: list) -> str:
+    '''报表的文本形式'''
+    batch_sizes = list(rows[0]['latency_ms'])
+    lines = ['{:<10}{:>10}{:>10}{:>12}'.format('mode', 'accuracy', 'delta', 'size(MB)')
+             + ''.join('{:>16}'.format(f'latency@{size}(ms)') for size in batch_sizes)]
+    for row in rows:
+        lines.append('{:<10}{:>10.4f}{:>+10.4f}{:>12.2f}'.format(
+            row['mode'], row['accuracy'], row['accuracy_delta'], row['size_mb'])
+            + ''.join('{:>16.3f}'.format(row['latency_ms'][size]) for size in batch_sizes))
+    return '\n'.join(lines)
+
+
+def main(argv=None) -> None:
+    from torch.utils.data import DataLoader, TensorDataset
+
+    from .model.resnet import ResNet
+    from .nn import VGG
+    from .server import load_net
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', choices=['resnet', 'vgg'], default='resnet')
+    parser.add_argument('--checkpoint', default=None,
+                        help='权重管理器的文件夹')
+    parser.add_argument('--format', default='pth')
+    parser.add_argument('--c-in', type=int, default=3)
+    parser.add_argument('--num-class', type=int, default=10)
+    parser.add_argument('--c-base', type=int, default=16)
+    parser.add_argument('--fc-hid', type=int, default=512)
+    parser.add_argument('--input-height', type=int, default=64)
+    parser.add_argument('--engine', default=None)
+    parser.add_argument('--output', default=None,
+                        help='静态量化后的网络保存为TorchScript的路径')
+    args = parser.parse_args(argv)
+
+    if args.model == 'resnet':
+        net = ResNet(args.c_in, args.num_class, c_base=args.c_base)
+    else:
+        net = VGG(args.c_in, args.num_class, c_base=args.c_base,
+                  fc_hid=args.fc_hid, input_height=args.input_height)
+    if args.checkpoint is not None:
+        net = load_net(net, args.checkpoint, format=args.format)
+
+    # 随机数据，只用于检查流程；实际使用时应换成校准集和测试集
+    _ = tc.manual_seed(0)
+    X = tc.randn(256, args.c_in, args.input_height, args.input_height)
+    Y = tc.randint(0, args.num_class, (256,))
+    loader = DataLoader(TensorDataset(X, Y), batch_size=32)
+
+    nets, _ = quantization_report(net, loader, loader, engine=args.engine)
+    if args.output is not None:
+        with tc.no_grad():
+            traced = tc.jit.trace(nets['static'], X[:1])
+        tc.jit.save(traced, args.output)
+        print(f'Saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+'''
+本地推理服务
+把并发的请求合并为批，在线程池中推理，只依赖标准库的asyncio
+    POST /predict  请求体为{"input": 单个样本(嵌套列表)}
+        返回{"output": 网络输出, "class": 最大输出的序号}
+    GET /stats  请求数、延迟分位数、队列深度、批大小分布
+从权重管理器的文件夹启动:
+    python -m kl.deepnet.server --checkpoint ./trainer_output/checkpoint --c-in 3 --num-class 10
+不指定权重时，用随机初始化的ResNet在本地发送并发请求并打印统计:
+    python -m kl.deepnet.server
+'''
+from typing import Union, Optional
+from pathlib import Path
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+import torch as tc
+import torch.nn as nn
+
+from .trainer.checkpoint_manager import CheckpointManager
+from .trainer.timing import percentile, PERCENTILES
+
+
+def load_net(net: nn.Module,
+             root_dir: Union[str, Path],
+             format: str = 'pth',
+             pth_path: Union[str, Path, None] = None) -> nn.Module:
+    '''
+    从权重管理器的文件夹中加载网络的权重
+    只读取net，不读取优化器等状态
+    参数:
+        root_dir  权重管理器的根文件夹，例如Trainer的<roor_dir>/checkpoint
+        pth_path  指定的记录点，默认为最新的
+    '''
+    manager = CheckpointManager(modObj={'net': net},
+                                root_dir=root_dir,
+                                format=format)
+    if pth_path is None and len(manager.stack) == 0:
+        raise FileNotFoundError(f'No checkpoint found in {root_dir}.')
+    _ = manager.load(pth_path=pth_path, names=['net'])
+    return net.eval()
+
+
+class DynamicBatcher:
+    '''
+    动态批处理器
+    请求进入队列，凑满max_batch_size或最早的请求等待超过max_wait后合并为一批
+    批在线程池中推理，同时最多有num_worker个批在计算
+    所有计算线程都忙碌时不取出新的请求，请求在队列中累积，下一批会更大
+    一批中的请求按输入形状分组计算，形状错误的请求不影响其他请求
+    '''
+
+    def __init__(self,
+                 net: nn.Module,
+                 device: Union[str, tc.device] = 'cpu',
+                 max_batch_size: int = 32,
+                 max_wait: float = 0.005,
+                 num_worker: int = 1,
+                 max_record: int = 10000,
+                 input_shape: Optional[tuple] = None):
+        '''
+        参数:
+            max_wait  批中第一个请求的最长等待时间(秒)
+            num_worker  推理线程数
+            max_record  统计时保留的最近请求数
+            input_shape  单个样本的形状，None表示该维度不限，用于在入队前检查请求
+        '''
+        self.net = net.eval()
+        self.device = tc.device(device)
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait
+        self.num_worker = max(num_worker, 1)
+        self.input_shape = input_shape
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.num_worker)
+
+        # 统计
+        # 每个请求从进入队列到得到结果的时间(秒)
+        self.latencies = collections.deque(maxlen=max_record)
+        # 每次组批时队列中剩余的请求数
+        self.queue_depths = collections.deque(maxlen=max_record)
+        # 批大小-次数
+        self.batch_sizes = collections.Counter()
+        self.num_request = 0
+        self.num_error = 0
+
+        # 在事件循环中创建
+        self._queue = None
+        self._slots = None
+        self._getter = None
+        self._loop_task = None
+        self._batch_tasks = set()
+
+    async def start(self) -> None:
+        '''在当前事件循环中开始组批'''
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.num_worker)
+        self._loop_task = asyncio.create_task(self._batch_loop())
+
+    async def close(self) -> None:
+        '''停止组批，等待正在计算的批完成'''
+        for task in [self._loop_task, self._getter]:
+            if task is not None:
+                task.cancel()
+        if len(self._batch_tasks) > 0:
+            _ = await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    def check_input(self, X: tc.Tensor) -> None:
+        '''检查单个样本的形状，不符合时抛出ValueError'''
+        if self.input_shape is None:
+            return
+        if X.dim() != len(self.input_shape) or any(
+                size is not None and size != actual
+                for size, actual in zip(self.input_shape, X.shape)):
+            raise ValueError(
+                f'Input shape {tuple(X.shape)} does not match {tuple(self.input_shape)}.')
+
+    async def predict(self, X: tc.Tensor) -> tc.Tensor:
+        '''
+        提交单个样本，等待所在的批计算完成
+        返回:
+            该样本的输出
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((X, future, time.perf_counter()))
+        return await future
+
+    async def _next_request(self, timeout: Optional[float] = None):
+        '''
+        取出一个请求，超时返回None
+        超时时保留等待中的get，下次继续使用，不会丢失请求
+        '''
+        if self._getter is None:
+            if not self._queue.empty():
+                return self._queue.get_nowait()
+            self._getter = asyncio.ensure_future(self._queue.get())
+        done, _ = await asyncio.wait({self._getter}, timeout=timeout)
+        if len(done) == 0:
+            return None
+        request, self._getter = self._getter.result(), None
+        return request
+
+    async def _batch_loop(self) -> None:
+        while True:
+            # 等待空闲的计算线程
+            await self._slots.acquire()
+            requests = [await self._next_request()]
+            deadline = requests[0][2] + self.max_wait
+            while len(requests) < self.max_batch_size:
+                request = await self._next_request(
+                    timeout=max(deadline - time.perf_counter(), 0))
+                if request is None:
+                    break
+                requests.append(request)
+            self.queue_depths.append(self._queue.qsize())
+
+            task = asyncio.create_task(self._run_batch(requests))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, requests: list) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+            # 形状相同的请求才能合并
+            groups = collections.defaultdict(list)
+            for request in requests:
+                groups[tuple(request[0].shape)].append(request)
+            for group in groups.values():
+                try:
+                    outputs = await loop.run_in_executor(
+                        self.executor, self._forward, [request[0] for request in group])
+                except Exception as error:
+                    self.num_error += len(group)
+                    for _, future, _ in group:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+
+                time_end = time.perf_counter()
+                for (_, future, time_begin), output in zip(group, outputs):
+                    if not future.done():
+                        future.set_result(output)
+                    self.latencies.append(time_end - time_begin)
+                self.batch_sizes[len(group)] += 1
+                self.num_request += len(group)
+        finally:
+            self._slots.release()
+
+    def _forward(self, inputs: list) -> list:
+        '''在计算线程中推理一批'''
+        with tc.inference_mode():
+            Y = self.net(tc.stack(inputs).to(self.device))
+        return list(Y.float().cpu())
+
+    def stats(self) -> dict:
+        '''延迟(毫秒)、队列深度和批大小的统计'''
+        latencies = sorted(self.latencies)
+        num_batch = sum(self.batch_sizes.values())
+        return {
+            'num_request': self.num_request,
+            'num_batch': num_batch,
+            'num_error': self.num_error,
+            'latency_ms': {f'p{q}': percentile(latencies, q)*1e3
+                           for q in PERCENTILES},
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'queue_depth_max': max(self.queue_depths, default=0),
+            'batch_size_mean': self.num_request / max(num_batch, 1),
+            'batch_size_count': {str(size): count
+                                 for size, count in sorted(self.batch_sizes.items())},
+        }
+
+
+# HTTP状态码的说明
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           500: 'Internal Server Error'}
+
+
+class InferenceServer:
+    '''
+    最小的HTTP服务
+    每个连接处理一个请求，只用于本地部署和测试
+    '''
+
+    def __init__(self,
+                 batcher: DynamicBatcher,
+                 host: str = '127.0.0.1',
+                 port: int = 8000):
+        '''
+        参数:
+            port  端口，0表示由系统分配，启动后从self.port读取
+        '''
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self) -> None:
+        await self.batcher.start()
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self) -> None:
+        await self._server.serve_forever()
+
+    async def close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+        await self.batcher.close()
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, body = await _read_request(reader)
+            status, result = await self._route(method, path, body)
+        except Exception as error:
+            status, result = 400, {'error': str(error)}
+        payload = json.dumps(result).encode()
+        writer.write(('HTTP/1.1 {} {}\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: {}\r\n'
+                      'Connection: close\r\n\r\n').format(
+                          status, REASONS[status], len(payload)).encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple:
+        if method == 'GET' and path == '/stats':
+            return 200, self.batcher.stats()
+        if method == 'POST' and path == '/predict':
+            X = tc.tensor(json.loads(body)['input'], dtype=tc.float32)
+            try:
+                # 形状错误的请求不进入队列
+                self.batcher.check_input(X)
+            except ValueError as error:
+                return 400, {'error': str(error)}
+            try:
+                Y = await self.batcher.predict(X)
+            except Exception as error:
+                return 500, {'error': str(error)}
+            return 200, {'output': Y.tolist(), 'class': int(Y.argmax())}
+        return 404, {'error': f'No route for {method} {path}.'}
+
+
+async def _read_request(reader: asyncio.StreamReader) -> tuple:
+    '''读取一个HTTP请求，返回方法、路径和请求体'''
+    request_line = (await reader.readline()).decode('latin-1')
+    method, path, _ = request_line.split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, body
+
+
+async def request(host: str,
+                  port: int,
+                  method: str = 'GET',
+                  path: str = '/stats',
+                  data: Optional[dict] = None) -> tuple:
+    '''
+    发送一个HTTP请求，用于本地测试
+    返回:
+        状态码和解析后的JSON
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    body = b'' if data is None else json.dumps(data).encode()
+    writer.write(('{} {} HTTP/1.1\r\nHost: {}\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: {}\r\n\r\n').format(
+                      method, path, host, len(body)).encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    return status, json.loads(payload)
+
+
+async def _demo(server: InferenceServer, num_request: int,
+                input_shape: tuple) -> None:
+    '''发送并发请求，打印统计'''
+    await server.start()
+    try:
+        time_begin = time.perf_counter()
+        results = await asyncio.gather(*[
+            request(server.host, server.port, 'POST', '/predict',
+                    {'input': tc.randn(input_shape).tolist()})
+            for _ in range(num_request)])
+        time_delta = time.perf_counter() - time_begin
+        num_ok = sum(status == 200 for status, _ in results)
+        print(f'{num_ok}/{num_request} requests succeeded in {time_delta:.2f}s')
+        _, stats = await request(server.host, server.port, 'GET', '/stats')
+        print(json.dumps(stats, indent=4))
+    finally:
+        await server.close()
+
+
+def main(argv: Optional[list] = None) -> None:
+    from .model.resnet import ResNet
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', default=None,
+                        help='权重管理器的文件夹，不指定时运行本地演示')
+    parser.add_argument('--format', default='pth')
+    parser.add_argument('--c-in', type=int, default=3)
+    parser.add_argument('--num-class', type=int, default=10)
+    parser.add_argument('--c-base', type=int, default=64)
+    parser.add_argument('--input-height', type=int, default=64,
+                        help='演示时输入图像的高度')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--num-request', type=int, default=256,
+                        help='演示时发送的请求数')
+    args = parser.parse_args(argv)
+
+    net = ResNet(args.c_in, args.num_class, c_base=args.c_base)
+    if args.checkpoint is not None:
+        net = load_net(net, args.checkpoint, format=args.format)
+    batcher = DynamicBatcher(net.to(args.device),
+                             device=args.device,
+                             max_batch_size=args.max_batch_size,
+                             max_wait=args.max_wait_ms / 1e3,
+                             num_worker=args.workers,
+                             input_shape=(args.c_in, None, None))
+
+    if args.checkpoint is None:
+        server = InferenceServer(batcher, host=args.host, port=0)
+        asyncio.run(_demo(server, args.num_request,
+                          (args.c_in, args.input_height, args.input_height)))
+        return
+
+    async def run():
+        server = InferenceServer(batcher, host=args.host, port=args.port)
+        await server.start()
+        print(f'Serving on http://{server.host}:{server.port}')
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,6 @@
 from .trainer import Trainer, SummaryManager, EarlyStop, CheckpointManager
+from .metric import Accuracy
+from .distributed import launch
+from .ensemble import EnsembleTrainer
+from .sweep import Sweep
+from .sample_cache import CachedDataset
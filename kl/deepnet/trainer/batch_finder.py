@@ -0,0 +1,204 @@
+from typing import Union, Optional, Callable
+import threading
+import time
+
+import torch as tc
+
+from .util import current_rss_mb, total_memory_mb
+
+
+def is_oom_error(error: BaseException) -> bool:
+    '''是否是内存不足的异常(CUDA或CPU)'''
+    message = str(error)
+    return isinstance(error, RuntimeError) and (
+        'out of memory' in message or "can't allocate memory" in message)
+
+
+def take_rows(data, num_row: int):
+    '''把批数据中的张量循环重复或截取为num_row行，用于试探批大小'''
+    if isinstance(data, tc.Tensor):
+        idx = tc.arange(num_row, device=data.device) % len(data)
+        return data[idx]
+    if isinstance(data, (list, tuple)):
+        return type(data)(take_rows(item, num_row) for item in data)
+    if isinstance(data, dict):
+        return {key: take_rows(value, num_row) for key, value in data.items()}
+    return data
+
+
+def default_memory_limit_mb(device: tc.device) -> float:
+    '''默认的内存预算：CUDA为显存的90%，CPU为物理内存的80%'''
+    if device.type == 'cuda':
+        return tc.cuda.get_device_properties(device).total_memory / 1024**2 * 0.9
+    return total_memory_mb() * 0.8
+
+
+class MemoryMonitor:
+    '''
+    记录一段代码运行期间的内存峰值(MB)
+    CUDA使用显存分配器的统计，CPU在后台线程中定期读取常驻内存
+        with MemoryMonitor(device) as monitor:
+            ...
+        monitor.peak_mb
+    '''
+
+    def __init__(self, device: tc.device, interval: float = 0.001):
+        self.device = device
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def current_mb(self) -> float:
+        if self.device.type == 'cuda':
+            return tc.cuda.memory_allocated(self.device) / 1024**2
+        return current_rss_mb()
+
+    def __enter__(self) -> 'MemoryMonitor':
+        self.peak_mb = self.current_mb()
+        if self.device.type == 'cuda':
+            tc.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def __exit__(self, *args) -> None:
+        if self.device.type == 'cuda':
+            self.peak_mb = max(self.peak_mb,
+                               tc.cuda.max_memory_allocated(self.device) / 1024**2)
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+
+def _release_memory() -> None:
+    if tc.cuda.is_available():
+        tc.cuda.empty_cache()
+
+
+def probe(fn: Callable,
+          data,
+          batch_size: int,
+          device: tc.device,
+          num_step: int = 3,
+          num_warmup: int = 1) -> dict:
+    '''
+    用batch_size运行fn若干次，测量吞吐量和内存峰值
+    返回:
+        {'batch_size', 'speed'(样本/秒), 'memory_mb'(峰值), 'status'}
+        status为ok或oom
+    '''
+    data = take_rows(data, batch_size)
+    is_cuda = device.type == 'cuda'
+    try:
+        with MemoryMonitor(device) as monitor:
+            for _ in range(num_warmup):
+                fn(data)
+            if is_cuda:
+                tc.cuda.synchronize(device)
+            time_begin = time.perf_counter()
+            for _ in range(num_step):
+                fn(data)
+            if is_cuda:
+                tc.cuda.synchronize(device)
+            time_delta = time.perf_counter() - time_begin
+    except RuntimeError as error:
+        if not is_oom_error(error):
+            raise
+        data = None
+        _release_memory()
+        return {'batch_size': batch_size, 'speed': None,
+                'memory_mb': None, 'status': 'oom'}
+    return {'batch_size': batch_size,
+            'speed': batch_size*num_step / max(time_delta, 1e-9),
+            'memory_mb': monitor.peak_mb,
+            'status': 'ok'}
+
+
+def search_batch_size(fn: Callable,
+                      data,
+                      batch_size: int = 1,
+                      max_batch_size: int = 4096,
+                      memory_limit_mb: Optional[float] = None,
+                      device: Union[str, tc.device] = 'cpu',
+                      num_step: int = 3,
+                      num_warmup: int = 1) -> list:
+    '''
+    从batch_size开始倍增批大小，逐个测量吞吐量和内存峰值
+    在内存不足、超过内存预算或达到max_batch_size时停止
+    CPU上内存耗尽时进程可能直接被系统终止，无法捕获异常
+    因此按已测量的内存随批大小线性增长估计下一个批大小的内存，预计超出预算时不再运行
+    参数:
+        fn  对一个批做计算的函数
+        data  一个批的数据，会被重复为需要的大小
+        memory_limit_mb  内存预算，None时使用default_memory_limit_mb
+    返回:
+        每个批大小的测量结果，status为ok、oom、over_budget(实测超出)、skipped(预计超出)
+    '''
+    device = tc.device(device)
+    if memory_limit_mb is None:
+        memory_limit_mb = default_memory_limit_mb(device)
+
+    _release_memory()
+    # 试探前已占用的内存
+    memory_base = MemoryMonitor(device).current_mb()
+
+    records = []
+    size = max(min(batch_size, max_batch_size), 1)
+    while True:
+        record = probe(fn, data, size, device=device,
+                       num_step=num_step, num_warmup=num_warmup)
+        if record['status'] == 'ok' and record['memory_mb'] > memory_limit_mb:
+            record['status'] = 'over_budget'
+        records.append(record)
+        if record['status'] != 'ok' or size >= max_batch_size:
+            break
+
+        next_size = min(size*2, max_batch_size)
+        # 内存随批大小线性增长的估计
+        memory_used = max(record['memory_mb'] - memory_base, 0)
+        memory_next = memory_base + memory_used * next_size / size
+        if memory_next > memory_limit_mb:
+            records.append({'batch_size': next_size, 'speed': None,
+                            'memory_mb': memory_next, 'status': 'skipped'})
+            break
+        size = next_size
+    return records
+
+
+def find_batch_size(fn: Callable,
+                    data,
+                    batch_size: int,
+                    max_batch_size: int = 4096,
+                    memory_limit_mb: Optional[float] = None,
+                    device: Union[str, tc.device] = 'cpu') -> int:
+    '''
+    能够运行的最大批大小
+    从batch_size开始倍增，batch_size本身就无法运行时减半直到可以运行
+    '''
+    records = search_batch_size(fn, data, batch_size=batch_size,
+                                max_batch_size=max_batch_size,
+                                memory_limit_mb=memory_limit_mb,
+                                device=device, num_step=1, num_warmup=0)
+    sizes = [record['batch_size'] for record in records
+             if record['status'] == 'ok']
+    if len(sizes) > 0:
+        return max(sizes)
+
+    size = records[0]['batch_size']
+    while size > 1:
+        size //= 2
+        records = search_batch_size(fn, data, batch_size=size,
+                                    max_batch_size=size,
+                                    memory_limit_mb=memory_limit_mb,
+                                    device=device, num_step=1, num_warmup=0)
+        if records[0]['status'] == 'ok':
+            return size
+    raise RuntimeError('Out of memory even with batch size 1.')
@@ -1,9 +1,31 @@
-from typing import Union, Optional
-import os
+from typing import Union, Optional, Iterable, Literal, Callable
+import queue
+import threading
 from pathlib import Path
 
 import torch as tc
 
+import torch.nn as nn
+
+from .checkpoint_storage import STORAGES, EXTRA_KEY
+
+
+def snapshot_to_cpu(obj):
+    '''
+    复制状态(可嵌套的字典、列表、元组)中的所有张量到CPU内存
+    之后训练继续修改权重也不会影响快照
+    '''
+    if isinstance(obj, tc.Tensor):
+        obj = obj.detach()
+        if obj.device.type == 'cpu':
+            return obj.clone()
+        return obj.to('cpu')
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(item) for item in obj)
+    return obj
+
 
 class CheckpointManager:
     '''权重文件管理器'''
@@ -11,7 +33,21 @@ class CheckpointManager:
     def __init__(self,
                  modObj: dict = None,
                  root_dir: Union[str, Path] = './checkpoint/',
-                 max_count: int = 3):
+                 max_count: int = 3,
+                 async_write: bool = False,
+                 max_pending: int = 1,
+                 format: Literal['pth', 'dir', 'dedup'] = 'pth'):
+        '''
+        参数:
+            async_write  是否在后台线程中写文件
+                保存时只把权重复制到CPU内存，训练随即继续
+            max_pending  异步模式下，尚未写完的快照数量上限
+                达到上限时，下一次保存会等待
+            format  文件格式
+                pth  每个记录点一个文件
+                dir  每个记录点一个文件夹，每个模块一个文件，可以只加载部分模块
+                dedup  张量按内容只保存一次，每个记录点只是一个清单
+        '''
         # “网络名-网络”的字典
         # 可以后续修改
         self.modObj = modObj
@@ -20,6 +56,13 @@ class CheckpointManager:
         # 创建根文件夹
         self.root_dir.mkdir(parents=True, exist_ok=True)
 
+        # 文件格式
+        if format not in STORAGES:
+            raise ValueError(
+                f'Unknown checkpoint format "{format}", should be one of {list(STORAGES)}.')
+        self.format = format
+        self.storage = STORAGES[format](self.root_dir)
+
         # 最大文件数
         self.max_count = max_count
 
@@ -28,6 +71,17 @@ class CheckpointManager:
         # 检查已有的权重
         self.check_existing_pth()
 
+        # 异步写入
+        self.async_write = async_write
+        # 限制同时存在的快照数量
+        self._pending = threading.BoundedSemaphore(max(max_pending, 1))
+        # 写入任务队列
+        self._tasks = queue.Queue()
+        # 后台线程，第一次保存时创建
+        self._writer = None
+        # 后台线程中出现的异常
+        self._error = None
+
     def get_last_idx(self):
         '''得到已有的最新的序号'''
         if len(self.stack) > 0:
@@ -39,42 +93,138 @@ class CheckpointManager:
     def check_existing_pth(self):
         '''检查已有的权重文件'''
         # 转化为数字
-        files = [int(fp.stem) for fp in self.root_dir.glob('*.pth')]
+        files = self.storage.list_idx()
         # 记录权重序号
         # 从小到大排序
         self.stack = sorted(files)
 
-    def save(self):
-        '''保存当前的权重'''
+    def save(self,
+             extra: Optional[dict] = None,
+             on_written: Optional[Callable] = None):
+        '''
+        保存当前的权重
+        参数:
+            extra  与权重一起保存的其他状态，例如训练进度和随机数状态
+            on_written  权重写入完成后调用的函数，异步模式下在后台线程中调用
+                用于写入依赖于这份权重的其他文件，例如训练信息
+        '''
         # 新权重的序号
         new_idx = self.get_last_idx()+1
-        pth_path = self.root_dir / Path(str(new_idx)+'.pth')
 
-        # 保存权重
-        tc.save(
-            obj={mod_name: mod.state_dict()
-                 for mod_name, mod in self.modObj.items()},
-            f=pth_path)
+        obj = {mod_name: mod.state_dict()
+               for mod_name, mod in self.modObj.items()}
+        if extra is not None:
+            obj[EXTRA_KEY] = extra
 
+        # 需要删除的最旧的权重
+        oldest_idx = None
         if len(self.stack) >= self.max_count:
             # 如果已经达到数量限制
             # 弹出最旧的
             oldest_idx = self.stack.pop(0)
-            oldest_pth_path = self.root_dir / Path(str(oldest_idx)+'.pth')
-            # 删除该文件
-            os.remove(oldest_pth_path)
-
         # 加入新的权重序号
         self.stack.append(new_idx)
 
-    def load(self, pth_path: Union[str, Path, None] = None):
-        '''加载权重'''
+        if not self.async_write:
+            self._write(new_idx, obj, oldest_idx, on_written)
+            return
+
+        # 异步写入
+        self._raise_error()
+        # 快照数量达到上限时等待
+        self._pending.acquire()
+        try:
+            obj = snapshot_to_cpu(obj)
+        except BaseException:
+            self._pending.release()
+            raise
+        self._start_writer()
+        self._tasks.put((new_idx, obj, oldest_idx, on_written))
+
+    def _write(self, idx: int, obj: dict, oldest_idx: Optional[int] = None,
+               on_written: Optional[Callable] = None):
+        '''写入权重文件，并删除最旧的文件'''
+        self.storage.write(idx, obj)
+        if on_written is not None:
+            on_written()
+
+        if oldest_idx is not None:
+            # 删除该文件
+            self.storage.remove(oldest_idx)
+
+    def _start_writer(self):
+        '''启动后台写入线程'''
+        if self._writer is not None and self._writer.is_alive():
+            return
+        self._writer = threading.Thread(target=self._write_loop,
+                                        daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        '''按保存顺序依次写入'''
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                self._tasks.task_done()
+                return
+            try:
+                self._write(*task)
+            except BaseException as error:
+                self._error = error
+            finally:
+                # 释放快照
+                task = None
+                self._pending.release()
+                self._tasks.task_done()
+
+    def _raise_error(self):
+        '''抛出后台线程中出现的异常'''
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Failed to write checkpoint.') from error
+
+    def wait(self):
+        '''等待所有异步写入完成'''
+        if self._writer is not None:
+            self._tasks.join()
+        self._raise_error()
+
+    def close(self):
+        '''等待写入完成，并结束后台线程'''
+        self.wait()
+        if self._writer is not None and self._writer.is_alive():
+            self._tasks.put(None)
+            self._writer.join()
+        self._writer = None
+
+    def load(self,
+             pth_path: Union[str, Path, None] = None,
+             names: Optional[Iterable[str]] = None) -> Optional[dict]:
+        '''
+        加载权重
+        文件以内存映射的方式打开，张量直接复制到已有的参数中
+        参数:
+            names  只加载这些模块，例如推理时只需要['net']
+        返回:
+            保存时附带的其他状态，没有时为None
+        '''
+        # 确保最新的权重已经写完
+        self.wait()
+
         if pth_path is None:
             # 加载最新的权重
             last_idx = self.get_last_idx()
-            pth_path = self.root_dir / Path(str(last_idx)+'.pth')
+            pth_path = self.storage.get_path(last_idx)
+        if names is None:
+            names = list(self.modObj)
         # 打开权重文件
-        pth = tc.load(pth_path)
-        for mod_name, mod in self.modObj.items():
+        pth = self.storage.read(pth_path, names=names)
+        for mod_name in names:
+            mod = self.modObj[mod_name]
+            state = pth[mod_name]
+            if not isinstance(mod, nn.Module):
+                # 优化器等对象会直接引用加载的张量，复制到内存中，与文件脱离
+                state = snapshot_to_cpu(state)
             # 网络加载对应权重
-            _ = mod.load_state_dict(pth[mod_name])
+            _ = mod.load_state_dict(state)
+        return snapshot_to_cpu(pth.get(EXTRA_KEY, None))
@@ -0,0 +1,249 @@
+from typing import Union, Optional, Iterable
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import torch as tc
+
+# 附加状态的名称
+EXTRA_KEY = '__extra__'
+
+
+class PthStorage:
+    '''
+    单文件格式
+    每个记录点是一个N.pth文件，包含所有模块的状态
+    '''
+
+    def __init__(self, root_dir: Union[str, Path]):
+        self.root_dir = Path(root_dir)
+
+    def get_path(self, idx: int) -> Path:
+        '''记录点的路径'''
+        return self.root_dir / Path(str(idx)+'.pth')
+
+    def list_idx(self) -> list:
+        '''已有记录点的序号'''
+        return [int(fp.stem) for fp in self.root_dir.glob('*.pth')
+                if fp.stem.isdigit()]
+
+    def write(self, idx: int, obj: dict) -> None:
+        pth_path = self.get_path(idx)
+        # 先写临时文件再重命名，中断时不会留下不完整的权重文件
+        tmp_path = pth_path.with_name(pth_path.name+'.tmp')
+        tc.save(obj=obj, f=tmp_path)
+        os.replace(tmp_path, pth_path)
+
+    def read(self, path: Union[str, Path],
+             names: Optional[Iterable[str]] = None) -> dict:
+        '''
+        读取记录点
+        使用内存映射，只有被访问的张量才会读入内存
+        参数:
+            names  需要的模块名，None表示全部
+        '''
+        pth = tc.load(path, mmap=True, map_location='cpu')
+        if names is None:
+            return pth
+        names = set(names) | {EXTRA_KEY}
+        return {name: value for name, value in pth.items() if name in names}
+
+    def remove(self, idx: int) -> None:
+        os.remove(self.get_path(idx))
+
+
+class DirStorage:
+    '''
+    分模块的文件夹格式
+    每个记录点是一个文件夹N/，每个模块保存为单独的文件，另有一个索引文件
+        N/index.json
+        N/net.pth
+        N/optimizer.pth
+        ...
+    读取时只打开需要的模块，例如推理时只读取net，不会读取优化器的状态
+    '''
+    index_name = 'index.json'
+
+    def __init__(self, root_dir: Union[str, Path]):
+        self.root_dir = Path(root_dir)
+
+    def get_path(self, idx: int) -> Path:
+        return self.root_dir / Path(str(idx))
+
+    def list_idx(self) -> list:
+        return [int(fp.name) for fp in self.root_dir.iterdir()
+                if fp.is_dir() and fp.name.isdigit()
+                and (fp / self.index_name).exists()]
+
+    def write(self, idx: int, obj: dict) -> None:
+        dir_path = self.get_path(idx)
+        # 先写入临时文件夹，全部完成后再重命名
+        tmp_path = dir_path.with_name(dir_path.name+'.tmp')
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+        tmp_path.mkdir(parents=True)
+
+        index = {'modules': {}}
+        for name, state in obj.items():
+            file_name = name+'.pth'
+            tc.save(obj=state, f=tmp_path / Path(file_name))
+            index['modules'][name] = file_name
+        # 索引最后写入
+        with open(tmp_path / Path(self.index_name), 'w', encoding='utf-8') as fp:
+            json.dump(index, fp=fp, indent=4, ensure_ascii=False)
+
+        if dir_path.exists():
+            shutil.rmtree(dir_path)
+        os.replace(tmp_path, dir_path)
+
+    def read(self, path: Union[str, Path],
+             names: Optional[Iterable[str]] = None) -> dict:
+        path = Path(path)
+        with open(path / Path(self.index_name), 'r', encoding='utf-8') as fp:
+            index = json.load(fp=fp)
+
+        modules = index['modules']
+        if names is not None:
+            names = set(names) | {EXTRA_KEY}
+            modules = {name: file_name for name, file_name in modules.items()
+                       if name in names}
+        # 每个模块单独映射
+        return {name: tc.load(path / Path(file_name), mmap=True, map_location='cpu')
+                for name, file_name in modules.items()}
+
+    def remove(self, idx: int) -> None:
+        shutil.rmtree(self.get_path(idx))
+
+
+# 清单中代表张量的键名
+BLOB_KEY = '__blob__'
+
+
+def tensor_digest(tensor: tc.Tensor) -> str:
+    '''张量内容的哈希值，包括数据类型和形状'''
+    tensor = tensor.detach().cpu().contiguous()
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{tensor.dtype}{tuple(tensor.shape)}'.encode())
+    # 按字节读取，兼容bfloat16等NumPy不支持的类型
+    digest.update(tensor.reshape(-1).view(tc.uint8).numpy().data)
+    return digest.hexdigest()
+
+
+class DedupStorage:
+    '''
+    内容寻址的增量格式
+    每个张量按内容的哈希值只保存一次，每个记录点只是一个清单
+        blobs/<哈希值>.pt  张量
+        N.manifest  去掉张量后的状态，张量替换为{'__blob__': 哈希值}
+    冻结的主干网络等没有变化的张量不会重复写入
+    删除记录点时，回收不再被任何清单引用的张量
+    '''
+
+    def __init__(self, root_dir: Union[str, Path]):
+        self.root_dir = Path(root_dir)
+        self.blob_dir = self.root_dir / Path('blobs')
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        # 每个清单引用的哈希值
+        self._refs = {}
+
+    def get_path(self, idx: int) -> Path:
+        return self.root_dir / Path(str(idx)+'.manifest')
+
+    def _get_blob_path(self, digest: str) -> Path:
+        return self.blob_dir / Path(digest+'.pt')
+
+    def list_idx(self) -> list:
+        return [int(fp.stem) for fp in self.root_dir.glob('*.manifest')
+                if fp.stem.isdigit()]
+
+    def _dedup(self, obj, refs: set):
+        '''把张量写入blobs并替换为引用'''
+        if isinstance(obj, tc.Tensor):
+            digest = tensor_digest(obj)
+            refs.add(digest)
+            blob_path = self._get_blob_path(digest)
+            if not blob_path.exists():
+                tensor = obj.detach().cpu()
+                if tensor.untyped_storage().nbytes() != tensor.numel()*tensor.element_size():
+                    # 视图会保存整个存储，复制出独立的张量
+                    tensor = tensor.clone()
+                tmp_path = blob_path.with_name(blob_path.name+'.tmp')
+                tc.save(tensor, tmp_path)
+                os.replace(tmp_path, blob_path)
+            return {BLOB_KEY: digest}
+        if isinstance(obj, dict):
+            return {key: self._dedup(value, refs) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._dedup(item, refs) for item in obj)
+        return obj
+
+    def _resolve(self, obj):
+        '''把引用替换为内存映射的张量'''
+        if isinstance(obj, dict):
+            if len(obj) == 1 and BLOB_KEY in obj:
+                return tc.load(self._get_blob_path(obj[BLOB_KEY]),
+                               mmap=True, map_location='cpu')
+            return {key: self._resolve(value) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._resolve(item) for item in obj)
+        return obj
+
+    def _collect_refs(self, obj, refs: set) -> set:
+        '''清单中引用的所有哈希值'''
+        if isinstance(obj, dict):
+            if len(obj) == 1 and BLOB_KEY in obj:
+                refs.add(obj[BLOB_KEY])
+            else:
+                for value in obj.values():
+                    self._collect_refs(value, refs)
+        elif isinstance(obj, (list, tuple)):
+            for item in obj:
+                self._collect_refs(item, refs)
+        return refs
+
+    def write(self, idx: int, obj: dict) -> None:
+        refs = set()
+        manifest = self._dedup(obj, refs)
+        # 所有张量写完后再写清单
+        path = self.get_path(idx)
+        tmp_path = path.with_name(path.name+'.tmp')
+        tc.save(manifest, tmp_path)
+        os.replace(tmp_path, path)
+        self._refs[idx] = refs
+
+    def read(self, path: Union[str, Path],
+             names: Optional[Iterable[str]] = None) -> dict:
+        manifest = tc.load(path)
+        if names is not None:
+            names = set(names) | {EXTRA_KEY}
+            manifest = {name: value for name, value in manifest.items()
+                        if name in names}
+        return self._resolve(manifest)
+
+    def remove(self, idx: int) -> None:
+        os.remove(self.get_path(idx))
+        _ = self._refs.pop(idx, None)
+        self.collect_garbage()
+
+    def collect_garbage(self) -> None:
+        '''删除不再被任何清单引用的张量'''
+        alive = set()
+        for idx in self.list_idx():
+            if idx not in self._refs:
+                # 之前运行时保存的清单
+                self._refs[idx] = self._collect_refs(
+                    tc.load(self.get_path(idx)), set())
+            alive |= self._refs[idx]
+        for blob_path in self.blob_dir.glob('*.pt'):
+            if blob_path.stem not in alive:
+                os.remove(blob_path)
+
+
+# 格式名称与存储类的对应
+STORAGES = {
+    'pth': PthStorage,
+    'dir': DirStorage,
+    'dedup': DedupStorage,
+}
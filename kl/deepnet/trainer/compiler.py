@@ -0,0 +1,47 @@
+from typing import Optional
+
+import torch as tc
+import torch.nn as nn
+
+
+def compile_module(net: nn.Module,
+                   backend: str = 'inductor',
+                   mode: Optional[str] = None) -> nn.Module:
+    '''
+    编译网络
+    参数:
+        backend  torchscript使用tc.jit.script，其余传给tc.compile
+            例如inductor、aot_eager、eager
+        mode  tc.compile的模式，例如reduce-overhead、max-autotune
+    '''
+    if backend == 'torchscript':
+        return tc.jit.script(net)
+    return tc.compile(net, backend=backend, mode=mode)
+
+
+def compile_function(fn,
+                     backend: str = 'inductor',
+                     mode: Optional[str] = None):
+    '''编译普通函数，TorchScript不支持时原样返回'''
+    if backend == 'torchscript':
+        return fn
+    return tc.compile(fn, backend=backend, mode=mode)
+
+
+class BufferSnapshot:
+    '''
+    保存网络的缓冲区(例如BatchNorm的统计量)
+    预热时的前向计算会修改缓冲区，结束后需要还原
+    '''
+
+    def __init__(self, net: nn.Module):
+        self.net = net
+        with tc.no_grad():
+            self.buffers = {name: buffer.clone()
+                            for name, buffer in net.named_buffers()}
+
+    def restore(self) -> None:
+        with tc.no_grad():
+            for name, buffer in self.net.named_buffers():
+                if name in self.buffers:
+                    _ = buffer.copy_(self.buffers[name])
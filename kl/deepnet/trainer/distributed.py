@@ -0,0 +1,187 @@
+from typing import Union, Optional, Callable
+import os
+import socket
+
+import torch as tc
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+def is_distributed() -> bool:
+    '''是否处于分布式环境中'''
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    '''当前进程的序号，非分布式环境下为0'''
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    '''进程总数，非分布式环境下为1'''
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def all_reduce(value: Union[int, float, tc.Tensor],
+               op: str = 'mean') -> float:
+    '''
+    在所有进程间规约一个数值
+    参数:
+        op  mean或sum
+    '''
+    if not is_distributed():
+        return float(value)
+
+    # gloo只支持CPU张量
+    tensor = tc.as_tensor(value, dtype=tc.float64).detach().clone()
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    else:
+        tensor = tensor.cpu()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    if op == 'mean':
+        tensor /= get_world_size()
+    return tensor.item()
+
+
+def broadcast_object(obj, src: int = 0):
+    '''将主进程的对象广播到所有进程'''
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+def gather_object(obj, dst: int = 0) -> Optional[list]:
+    '''
+    把每个进程的对象收集到dst进程
+    返回:
+        dst进程上为按进程序号排列的列表，其他进程为None
+    '''
+    if not is_distributed():
+        return [obj]
+    objs = [None] * get_world_size() if get_rank() == dst else None
+    dist.gather_object(obj, objs, dst=dst)
+    return objs
+
+
+def distributed_loader(data_loader: DataLoader,
+                       shuffle: Optional[bool] = None) -> DataLoader:
+    '''
+    用DistributedSampler重建数据加载器，每个进程只读取自己的分片
+    参数:
+        shuffle  是否打乱，默认与原加载器一致
+    '''
+    if shuffle is None:
+        shuffle = isinstance(data_loader.sampler, RandomSampler)
+    sampler = DistributedSampler(data_loader.dataset,
+                                 num_replicas=get_world_size(),
+                                 rank=get_rank(),
+                                 shuffle=shuffle,
+                                 drop_last=data_loader.drop_last)
+    return DataLoader(data_loader.dataset,
+                      batch_size=data_loader.batch_size,
+                      sampler=sampler,
+                      num_workers=data_loader.num_workers,
+                      collate_fn=data_loader.collate_fn,
+                      pin_memory=data_loader.pin_memory,
+                      drop_last=data_loader.drop_last,
+                      timeout=data_loader.timeout,
+                      worker_init_fn=data_loader.worker_init_fn,
+                      persistent_workers=data_loader.persistent_workers)
+
+
+def _free_port() -> int:
+    '''找一个空闲的本地端口'''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _worker(rank: int,
+            fn: Callable,
+            world_size: int,
+            num_thread: int,
+            backend: str,
+            master_addr: str,
+            master_port: int,
+            args: tuple):
+    '''每个子进程的入口'''
+    # 限制每个进程的线程数，防止进程间争抢CPU
+    tc.set_num_threads(num_thread)
+
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    dist.init_process_group(backend=backend,
+                            rank=rank,
+                            world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn: Callable,
+           num_process: int = 2,
+           args: tuple = (),
+           backend: str = 'gloo',
+           master_addr: str = '127.0.0.1',
+           master_port: Optional[int] = None) -> None:
+    '''
+    启动多进程数据并行训练
+    参数:
+        fn  每个进程执行的函数，调用方式为fn(rank, world_size, *args)
+            必须定义在模块顶层，以便被子进程导入
+            函数内创建Trainer时应指定distributed=True
+        num_process  进程数
+        backend  通信后端，CPU使用gloo
+    '''
+    if master_port is None:
+        master_port = _free_port()
+    num_thread = max(tc.get_num_threads() // num_process, 1)
+    mp.spawn(_worker,
+             args=(fn, num_process, num_thread, backend,
+                   master_addr, master_port, args),
+             nprocs=num_process,
+             join=True)
+
+
+def _demo_fit(rank: int, world_size: int, root_dir: str):
+    '''在随机数据上训练一个小网络，用于检查分布式训练'''
+    import torch.nn as nn
+    from torch.utils.data import TensorDataset
+
+    from .trainer import Trainer
+    from .metric import Accuracy
+
+    # 每个进程的初始权重必须一致，DDP会从0号进程广播
+    _ = tc.manual_seed(0)
+    X = tc.randn(1024, 16)
+    Y = (X.sum(dim=1) > 0).long()
+    loader = DataLoader(TensorDataset(X, Y), batch_size=32, shuffle=True)
+    net = nn.Sequential(nn.Linear(16, 32), nn.ReLU(), nn.Linear(32, 2))
+
+    trainer = Trainer(net=net,
+                      loss_fn=nn.CrossEntropyLoss(),
+                      optimizer=tc.optim.SGD(net.parameters(), lr=0.1),
+                      metric=Accuracy(),
+                      data_train_loader=loader,
+                      data_test_loader=DataLoader(TensorDataset(X, Y),
+                                                  batch_size=64),
+                      num_epoch=3,
+                      verbose=2,
+                      roor_dir=root_dir,
+                      distributed=True)
+    trainer.fit()
+
+
+if __name__ == '__main__':
+    # 用两个CPU进程训练一个小网络
+    # python -m kl.deepnet.trainer.distributed
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        launch(_demo_fit, num_process=2, args=(root_dir,))
@@ -0,0 +1,225 @@
+from typing import Optional, Callable
+from pathlib import Path
+import copy
+import json
+import math
+
+import torch as tc
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+from .trainer import Trainer
+from .checkpoint_manager import CheckpointManager
+
+
+class StackedEnsemble(nn.Module):
+    '''
+    N个结构相同的网络，参数和缓冲区沿第0维堆叠
+    前向时用vmap一次计算所有副本，输出形状为(N, ...)
+    '''
+
+    def __init__(self, nets: list):
+        super().__init__()
+        self.num_replica = len(nets)
+        params, buffers = stack_module_state(nets)
+        # 参数名中有'.'，按顺序保存
+        self.param_names = list(params)
+        self.params = nn.ParameterList(
+            [nn.Parameter(params[name].detach()) for name in self.param_names])
+        self.buffer_names = list(buffers)
+        for idx, name in enumerate(self.buffer_names):
+            self.register_buffer(f'buffer{idx}', buffers[name])
+        # 只提供结构的网络，不注册为子模块
+        self._base = [copy.deepcopy(nets[0]).to('meta')]
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        self._base[0].train(mode)
+        return self
+
+    def _states(self) -> tuple:
+        params = dict(zip(self.param_names, self.params))
+        buffers = {name: getattr(self, f'buffer{idx}')
+                   for idx, name in enumerate(self.buffer_names)}
+        return params, buffers
+
+    def forward(self, X):
+        base = self._base[0]
+
+        def run(params, buffers, X):
+            return functional_call(base, (params, buffers), (X,))
+        # 每个副本使用不同的随机数(例如Dropout)
+        return vmap(run, in_dims=(0, 0, None), randomness='different')(
+            *self._states(), X)
+
+    def unstack(self, idx: int) -> nn.Module:
+        '''第idx个副本，作为普通的网络(CPU上的副本)'''
+        net = copy.deepcopy(self._base[0]).to_empty(device='cpu')
+        params, buffers = self._states()
+        state = {name: value[idx].detach().cpu()
+                 for name, value in {**params, **buffers}.items()}
+        _ = net.load_state_dict(state)
+        return net.train(self.training)
+
+
+class EnsembleMetric:
+    '''每个副本一个精度计算器，输入的形状为(b, N, ...)'''
+
+    def __init__(self, metric, num_replica: int):
+        self.metrics = [copy.deepcopy(metric) for _ in range(num_replica)]
+
+    def reset(self):
+        for metric in self.metrics:
+            _ = metric.reset()
+
+    def update(self, Y, Y_true):
+        for idx, metric in enumerate(self.metrics):
+            _ = metric.update(Y[:, idx], Y_true)
+
+    def compute(self):
+        '''所有副本的平均精度'''
+        return self.compute_all().mean()
+
+    def compute_all(self):
+        '''每个副本的精度'''
+        return tc.stack([tc.as_tensor(metric.compute()).float().cpu()
+                         for metric in self.metrics])
+
+
+class EnsembleTrainer(Trainer):
+    '''
+    向量化的集成训练
+    用model_factory(**config)为每个配置创建一个副本，参数沿第0维堆叠
+    所有副本在同一个进程中共用训练数据，每步一次前向、一次反向
+    副本之间没有梯度的交互，与分别训练等价
+    记录:
+        整体的记录为所有副本的平均值，早停也使用平均值
+        每个副本的记录的mode为train/replicaN、test/replicaN，Tensorboard中为单独的图表
+    权重:
+        堆叠的网络和优化器由权重管理器保存，用于继续训练
+        每个副本另外保存为普通网络的权重，位于根目录下的replicas/replicaN
+    '''
+
+    def __init__(self,
+                 model_factory: Callable,
+                 configs: list,
+                 loss_fn=None,
+                 optimizer_factory: Optional[Callable] = None,
+                 metric=None,
+                 device: str = 'cpu',
+                 **kwargs):
+        '''
+        参数:
+            model_factory  创建网络的函数，调用方式为model_factory(**config)
+                所有副本的结构必须相同，配置只能影响参数和缓冲区，例如随机数种子
+            configs  每个副本的配置
+            optimizer_factory  用堆叠后的参数创建优化器的函数
+                例如lambda params: tc.optim.SGD(params, lr=0.1)
+                学习率等超参数对所有副本相同
+            metric  精度计算器，每个副本复制一份
+            其他参数同Trainer
+        '''
+        for name in ['distributed', 'eval_config', 'compile_config',
+                     'checkpoint_interval']:
+            if kwargs.get(name, None):
+                raise ValueError(f'EnsembleTrainer does not support {name}.')
+
+        self.configs = configs
+        self.num_replica = len(configs)
+        nets = [model_factory(**config).to(device) for config in configs]
+        net = StackedEnsemble(nets)
+        super().__init__(net=net,
+                         loss_fn=loss_fn,
+                         optimizer=optimizer_factory(net.parameters()),
+                         metric=EnsembleMetric(metric, self.num_replica),
+                         device=device,
+                         **kwargs)
+        # 每个副本本轮损失的累加值
+        # find_batch_size等不经过_fit_batch的调用也会累加，每轮开始时清零
+        self._reset_replica_loss()
+
+        # 每个副本的权重管理器
+        if self.enable_checkpointManager:
+            self.replicaManagers = [
+                CheckpointManager(modObj={},
+                                  max_count=kwargs.get('checkpoint_limit', 3),
+                                  root_dir=self.roor_dir/Path('replicas')/Path(f'replica{idx}'),
+                                  **(kwargs.get('checkpoint_config', None) or {}))
+                for idx in range(self.num_replica)]
+        if self.is_main:
+            # 每个副本的配置
+            with open(self.roor_dir/Path('replicas.json'), 'w', encoding='utf-8') as fs:
+                json.dump(configs, fp=fs, indent=4, ensure_ascii=False,
+                          default=str)
+
+    def predict(self, data):
+        X = data[0].to(self.device)
+        Y_true = data[1].to(self.device)
+        # (N, b, ...) -> (b, N, ...)，使微批可以沿第0维拼接
+        Y = self.net(X).transpose(0, 1)
+        return Y, Y_true
+
+    def _forward_loss(self, data, mark: bool = True):
+        with self.precisionManager.autocast():
+            Y, Y_true = self.predict(data)
+            if mark:
+                self.timer.mark('forward')
+            # 每个副本的损失
+            losses = tc.stack([self.loss_fn(Y[:, idx], Y_true)
+                               for idx in range(self.num_replica)])
+        # 与基类的逐批损失一样按微批的样本比例加权
+        self._replica_loss_sum += losses.detach().float() * self._micro_weight
+        # 损失相加，每个副本的梯度只来自自己的损失
+        return Y, Y_true, losses.sum()
+
+    def _record_loss(self, loss):
+        '''显示和记录所有副本的平均损失'''
+        return loss / self.num_replica
+
+    def _reset_replica_loss(self):
+        self._replica_loss_sum = tc.zeros(self.num_replica, device=self.device)
+
+    def _fit_batch(self, is_training: bool = True):
+        self._reset_replica_loss()
+        epoch_info = super()._fit_batch(is_training)
+
+        accuracies = self.metric.compute_all().tolist()
+        # 与基类相同，每个逻辑批的加权损失按逻辑批数量平均
+        num_logical_batch = math.ceil(self.num_batch_train / self.num_accumulation_step)
+        losses = (self._replica_loss_sum / max(num_logical_batch, 1)).tolist()
+        replicas = []
+        for idx in range(self.num_replica):
+            info = {'accuracy': accuracies[idx]}
+            if is_training:
+                info['loss'] = losses[idx]
+            replicas.append(info)
+        epoch_info['replicas'] = replicas
+        return epoch_info
+
+    def _record_epoch(self, epoch_info: dict):
+        replicas = epoch_info.pop('replicas', [])
+        super()._record_epoch(epoch_info)
+        for idx, info in enumerate(replicas):
+            self.summaryManager.append(
+                input={**epoch_info, **info,
+                       'mode': '{}/replica{}'.format(epoch_info['mode'], idx)})
+
+    def save(self, resume_state: Optional[dict] = None):
+        super().save(resume_state=resume_state)
+        if not (self.is_main and self.enable_checkpointManager):
+            return
+        for idx, manager in enumerate(self.replicaManagers):
+            manager.modObj = {'net': self.raw_net.unstack(idx)}
+            manager.save(extra={'epoch': self.epoch})
+
+    def fit(self):
+        try:
+            super().fit()
+        finally:
+            if self.enable_checkpointManager:
+                for manager in self.replicaManagers:
+                    manager.wait()
+
+    def get_replica(self, idx: int) -> nn.Module:
+        '''第idx个副本，作为普通的网络'''
+        return self.raw_net.unstack(idx)
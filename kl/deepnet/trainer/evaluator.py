@@ -0,0 +1,160 @@
+from typing import Union
+import copy
+import queue
+import traceback
+
+import torch as tc
+import torch.multiprocessing as mp
+
+from .checkpoint_manager import snapshot_to_cpu
+from .precision import PrecisionManager
+from .prefetcher import Prefetcher
+from .timing import StepTimer, NullTimer
+
+
+def _eval_worker(trainer, task_queue, result_queue) -> None:
+    '''
+    测试进程
+    依次取出权重快照，加载后遍历测试集，返回本轮的测试结果
+    '''
+    trainer.raw_net.to(trainer.device)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        epoch, state = task
+        try:
+            _ = trainer.raw_net.load_state_dict(state)
+            # 释放快照
+            state = None
+            trainer.epoch = epoch
+            result_queue.put((epoch, trainer._fit_batch(is_training=False), None))
+        except BaseException:
+            result_queue.put((epoch, None, traceback.format_exc()))
+
+
+class AsyncEvaluator:
+    '''
+    异步测试器
+    每轮训练结束后，把权重快照交给独立的测试进程，训练随即开始下一轮
+    测试结果在之后取回，与串行测试的结果相同
+    '''
+
+    def __init__(self,
+                 trainer,
+                 device: Union[str, tc.device, None] = None,
+                 max_lag: int = 1):
+        '''
+        参数:
+            trainer  训练器，复制一份去掉训练用的对象后传给测试进程
+                训练器的子类需要可以被导入(定义在模块的顶层)
+            device  测试进程使用的设备，默认与训练相同
+            max_lag  尚未取回的测试结果数量上限
+                达到上限时，下一轮训练开始前会等待
+                0表示等待每一轮的测试完成，相当于串行测试
+        '''
+        self.max_lag = max(max_lag, 0)
+        # 已提交但尚未取回结果的轮次
+        self.pending = []
+
+        ctx = mp.get_context('spawn')
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._process = ctx.Process(
+            target=_eval_worker,
+            args=(self._build_eval_trainer(trainer, device),
+                  self._tasks, self._results),
+            daemon=True)
+        self._process.start()
+
+    @staticmethod
+    def _build_eval_trainer(trainer, device):
+        '''复制训练器，只保留测试需要的部分'''
+        eval_trainer = trainer.__class__.__new__(trainer.__class__)
+        eval_trainer.__dict__.update(trainer.__dict__)
+
+        device = trainer.device if device is None else tc.device(device)
+        eval_trainer.device = device
+        # 编译后的网络不能传给其他进程，复制未经包装的网络
+        eval_trainer.net = copy.deepcopy(trainer.raw_net).to('cpu')
+        eval_trainer.raw_net = eval_trainer.net
+        eval_trainer._forward_loss_fn = None
+        # 测试进程不打印，不写文件
+        eval_trainer.verbose = 0
+        for name in ['optimizer', 'data_train_loader', 'summaryManager',
+                     'checkpointManager', 'earlyStop', 'profiler', 'evaluator',
+                     'ddp_net']:
+            eval_trainer.__dict__.pop(name, None)
+        eval_trainer.enable_checkpointManager = False
+        eval_trainer.enable_earlyStop = False
+
+        # 预取线程不能传给其他进程，在测试进程中直接读取
+        test_loader = trainer.data_test_loader
+        if isinstance(test_loader, Prefetcher):
+            test_loader = test_loader.data_loader
+        eval_trainer.data_test_loader = test_loader
+
+        eval_trainer.precisionManager = PrecisionManager(
+            precision=trainer.precision, device=device)
+        eval_trainer.timer = StepTimer(device) if trainer.enable_timing \
+            else NullTimer()
+        return eval_trainer
+
+    def submit(self, epoch: int, state: dict) -> None:
+        '''提交一轮的权重，复制到CPU内存后立即返回'''
+        self._check_alive()
+        self._tasks.put((epoch, snapshot_to_cpu(state)))
+        self.pending.append(epoch)
+
+    def collect(self, block: bool = False) -> list:
+        '''
+        取回已完成的测试结果
+        参数:
+            block  是否等待，直到尚未取回的数量不超过max_lag
+        返回:
+            测试结果的列表，按轮次排序
+        '''
+        results = []
+        while len(self.pending) > 0:
+            must_wait = block and len(self.pending) > self.max_lag
+            try:
+                if must_wait:
+                    # 定期检查测试进程是否退出
+                    epoch, info, error = self._results.get(timeout=1.0)
+                else:
+                    epoch, info, error = self._results.get_nowait()
+            except queue.Empty:
+                if not must_wait:
+                    break
+                self._check_alive()
+                continue
+            self.pending.remove(epoch)
+            if error is not None:
+                raise RuntimeError(
+                    f'Evaluation of epoch {epoch} failed:\n{error}')
+            results.append(info)
+        return results
+
+    def drain(self) -> list:
+        '''等待并取回所有测试结果'''
+        max_lag, self.max_lag = self.max_lag, 0
+        try:
+            return self.collect(block=True)
+        finally:
+            self.max_lag = max_lag
+
+    def _check_alive(self) -> None:
+        if not self._process.is_alive():
+            raise RuntimeError(
+                f'Evaluation process exited with code {self._process.exitcode}.')
+
+    def close(self) -> None:
+        '''结束测试进程，未取回的结果被丢弃'''
+        if self._process.is_alive():
+            self._tasks.put(None)
+            self._process.join(timeout=10)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self.pending = []
+
@@ -0,0 +1,144 @@
+from typing import Union, Optional
+from pathlib import Path
+import queue
+import threading
+
+import numpy as np
+import torch as tc
+from torch.utils.data import DataLoader
+
+
+def rebatch_loader(data_loader: DataLoader, batch_size: int) -> DataLoader:
+    '''按顺序、以新的批大小读取同一个数据集，使输出与样本的序号对应'''
+    return DataLoader(data_loader.dataset,
+                      batch_size=batch_size,
+                      shuffle=False,
+                      num_workers=data_loader.num_workers,
+                      collate_fn=data_loader.collate_fn,
+                      pin_memory=data_loader.pin_memory,
+                      timeout=data_loader.timeout,
+                      worker_init_fn=data_loader.worker_init_fn,
+                      persistent_workers=data_loader.persistent_workers)
+
+
+class OutputWriter:
+    '''
+    推理输出的写入器
+    已知样本总数时，每个输出写入一个预先分配的.npy内存映射文件
+        <output_dir>/<name>.npy
+    否则每批写入一个分块文件
+        <output_dir>/<name>/<序号>.npy
+    写入在后台线程中进行，与计算重叠，内存占用与样本总数无关
+    '''
+
+    def __init__(self,
+                 output_dir: Union[str, Path],
+                 num_sample: Optional[int] = None,
+                 max_pending: int = 2):
+        '''
+        参数:
+            num_sample  样本总数，None表示未知
+            max_pending  尚未写入的批数量上限，达到上限时等待
+        '''
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.num_sample = num_sample
+
+        # 内存映射文件和已写入的行数
+        self._arrays = {}
+        self._offsets = {}
+        # 分块文件的路径
+        self._chunks = {}
+
+        self._tasks = queue.Queue(maxsize=max(max_pending, 1))
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def put(self, outputs: dict) -> None:
+        '''
+        提交一批的输出
+        参数:
+            outputs  “名称-张量”的字典，第一维是样本
+        '''
+        self._raise_error()
+        event = None
+        cpu_outputs = {}
+        for name, tensor in outputs.items():
+            tensor = tensor.detach()
+            if tensor.device.type == 'cuda':
+                # 异步复制，写入线程中等待复制完成
+                tensor = tensor.to('cpu', non_blocking=True)
+                if event is None:
+                    event = tc.cuda.Event()
+            cpu_outputs[name] = tensor
+        if event is not None:
+            event.record()
+        self._tasks.put((cpu_outputs, event))
+
+    def _write_loop(self) -> None:
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                self._tasks.task_done()
+                return
+            try:
+                if self._error is None:
+                    self._write(*task)
+            except BaseException as error:
+                self._error = error
+            finally:
+                task = None
+                self._tasks.task_done()
+
+    def _write(self, outputs: dict, event) -> None:
+        if event is not None:
+            event.synchronize()
+        for name, tensor in outputs.items():
+            array = tensor.numpy()
+            if self.num_sample is None:
+                # 分块文件
+                chunks = self._chunks.setdefault(name, [])
+                path = self.output_dir / Path(name) / Path(f'{len(chunks):06d}.npy')
+                path.parent.mkdir(parents=True, exist_ok=True)
+                np.save(path, array)
+                chunks.append(path)
+                continue
+
+            if name not in self._arrays:
+                # 第一批确定形状和数据类型
+                self._arrays[name] = np.lib.format.open_memmap(
+                    self.output_dir / Path(name+'.npy'), mode='w+',
+                    dtype=array.dtype, shape=(self.num_sample,)+array.shape[1:])
+                self._offsets[name] = 0
+            offset = self._offsets[name]
+            self._arrays[name][offset:offset+len(array)] = array
+            self._offsets[name] = offset+len(array)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Failed to write inference outputs.') from error
+
+    def close(self) -> dict:
+        '''
+        等待写入完成
+        返回:
+            “名称-输出”的字典，内存映射文件以只读方式打开，分块文件为路径列表
+        '''
+        self._tasks.put(None)
+        self._writer.join()
+        self._raise_error()
+
+        results = {}
+        for name, array in self._arrays.items():
+            array.flush()
+            if self._offsets[name] != self.num_sample:
+                raise RuntimeError(
+                    f'Output "{name}" has {self._offsets[name]} rows, '
+                    f'expected {self.num_sample}.')
+            results[name] = np.load(self.output_dir / Path(name+'.npy'),
+                                    mmap_mode='r')
+        self._arrays = {}
+        results.update(self._chunks)
+        return results
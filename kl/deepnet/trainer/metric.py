@@ -0,0 +1,29 @@
+from typing import Union
+
+import torch as tc
+
+
+class Accuracy:
+    '''
+    分类精度
+    状态保留在设备上，只在compute时规约
+    '''
+
+    def __init__(self, device: Union[str, tc.device] = 'cpu'):
+        self.device = tc.device(device)
+        self.reset()
+
+    def reset(self):
+        self.correct = tc.zeros((), dtype=tc.long, device=self.device)
+        self.total = tc.zeros((), dtype=tc.long, device=self.device)
+
+    def update(self, Y, Y_true):
+        # 设备跟随输入
+        if self.correct.device != Y_true.device:
+            self.correct = self.correct.to(Y_true.device)
+            self.total = self.total.to(Y_true.device)
+        self.correct += (Y.argmax(dim=-1) == Y_true).sum()
+        self.total += Y_true.numel()
+
+    def compute(self):
+        return self.correct / self.total.clamp(min=1)
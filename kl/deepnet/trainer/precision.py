@@ -0,0 +1,73 @@
+from typing import Literal
+import contextlib
+
+import torch as tc
+
+
+# 精度名称与数据类型的对应
+PRECISION_DTYPE = {
+    'fp32': tc.float32,
+    'bf16': tc.bfloat16,
+    'fp16': tc.float16,
+}
+
+
+class PrecisionManager:
+    '''
+    混合精度管理器
+        fp32  全精度，不做任何处理
+        bf16  bfloat16自动混合精度
+        fp16  float16自动混合精度+梯度缩放
+    '''
+
+    def __init__(self,
+                 precision: Literal['fp32', 'bf16', 'fp16'] = 'fp32',
+                 device: tc.device = tc.device('cpu')):
+        if precision not in PRECISION_DTYPE:
+            raise ValueError(
+                f'Unknown precision "{precision}", should be one of {list(PRECISION_DTYPE)}.')
+        self.precision = precision
+        self.device = device
+        self.dtype = PRECISION_DTYPE[precision]
+
+        # 是否开启自动混合精度
+        self.enable_autocast = precision != 'fp32'
+
+        # 梯度缩放器
+        # 只有fp16需要，bf16的指数位与fp32相同
+        self.scaler = None
+        if precision == 'fp16':
+            self.scaler = tc.amp.GradScaler(device.type)
+
+    def autocast(self):
+        '''前向计算(包括损失)的上下文'''
+        if not self.enable_autocast:
+            return contextlib.nullcontext()
+        return tc.autocast(device_type=self.device.type,
+                           dtype=self.dtype)
+
+    def backward(self, loss: tc.Tensor) -> None:
+        '''计算梯度'''
+        if self.scaler is None:
+            _ = loss.backward()
+        else:
+            # 放大损失，防止梯度下溢
+            _ = self.scaler.scale(loss).backward()
+
+    def step(self, optimizer) -> None:
+        '''更新权重'''
+        if self.scaler is None:
+            optimizer.step()
+        else:
+            # 还原梯度后更新，出现inf/nan时跳过本次更新
+            self.scaler.step(optimizer)
+            self.scaler.update()
+
+    def state_dict(self) -> dict:
+        if self.scaler is None:
+            return {}
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        if self.scaler is not None and len(state_dict) > 0:
+            self.scaler.load_state_dict(state_dict)
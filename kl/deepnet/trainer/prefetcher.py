@@ -0,0 +1,155 @@
+from typing import Union, Optional
+import copy
+import queue
+import threading
+
+import torch as tc
+
+
+def move_to_device(data, device: tc.device,
+                   pin_memory: bool = False,
+                   non_blocking: bool = False):
+    '''将批数据(可嵌套的列表、元组、字典)中的张量转移到指定设备'''
+    if isinstance(data, tc.Tensor):
+        if pin_memory and not data.is_pinned():
+            # 锁页内存，异步复制的前提
+            data = data.pin_memory()
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, (list, tuple)):
+        return type(data)(move_to_device(item, device, pin_memory, non_blocking)
+                          for item in data)
+    if isinstance(data, dict):
+        return {key: move_to_device(value, device, pin_memory, non_blocking)
+                for key, value in data.items()}
+    # 其他类型保持不变
+    return data
+
+
+class _End:
+    '''迭代结束的标志'''
+
+    def __init__(self, error: Optional[BaseException] = None):
+        # 后台线程中出现的异常
+        self.error = error
+
+
+class Prefetcher:
+    '''
+    批数据预取器
+    在后台线程中提前读取若干个批，并转移到目标设备
+    使数据加载、数据复制与计算重叠
+    '''
+
+    def __init__(self,
+                 data_loader,
+                 device: Union[str, tc.device] = 'cpu',
+                 num_prefetch: int = 2,
+                 pin_memory: bool = True,
+                 use_stream: bool = True):
+        '''
+        参数:
+            data_loader  被包装的数据加载器
+            num_prefetch  提前准备的批数量
+            pin_memory  复制前是否先放入锁页内存(只对CUDA有效)
+            use_stream  是否在独立的CUDA流上复制(只对CUDA有效)
+        '''
+        self.data_loader = data_loader
+        self.device = tc.device(device)
+        self.num_prefetch = max(num_prefetch, 1)
+
+        # 锁页内存和独立的流只对CUDA有意义
+        is_cuda = self.device.type == 'cuda'
+        self.pin_memory = pin_memory and is_cuda
+        self.non_blocking = is_cuda
+        self.stream = tc.cuda.Stream(self.device) \
+            if use_stream and is_cuda else None
+
+    def replace_loader(self, data_loader) -> 'Prefetcher':
+        '''用相同的设置包装另一个数据加载器'''
+        prefetcher = copy.copy(self)
+        prefetcher.data_loader = data_loader
+        return prefetcher
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def __getattr__(self, name):
+        # 其他属性(batch_size、dataset等)取自被包装的加载器
+        if name == 'data_loader':
+            raise AttributeError(name)
+        return getattr(self.data_loader, name)
+
+    def _worker(self, buffer: queue.Queue, stop: threading.Event):
+        '''后台线程，读取并转移数据'''
+        try:
+            for data in self.data_loader:
+                event = None
+                if self.stream is not None:
+                    with tc.cuda.stream(self.stream):
+                        data = move_to_device(data, self.device,
+                                              self.pin_memory, self.non_blocking)
+                    # 记录复制完成的事件
+                    event = tc.cuda.Event()
+                    event.record(self.stream)
+                else:
+                    data = move_to_device(data, self.device,
+                                          self.pin_memory, self.non_blocking)
+
+                # 队列满时等待，同时检查是否被要求停止
+                while not stop.is_set():
+                    try:
+                        buffer.put((data, event), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            buffer.put(_End())
+        except BaseException as error:
+            buffer.put(_End(error))
+
+    def __iter__(self):
+        buffer = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker,
+                                  args=(buffer, stop),
+                                  daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = buffer.get()
+                if isinstance(item, _End):
+                    if item.error is not None:
+                        raise item.error
+                    break
+
+                data, event = item
+                if event is not None:
+                    # 计算流等待复制完成
+                    current_stream = tc.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # 防止张量在计算流使用前被回收
+                    _record_stream(data, current_stream)
+                yield data
+        finally:
+            # 提前退出时通知后台线程结束
+            stop.set()
+            while thread.is_alive():
+                try:
+                    _ = buffer.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(timeout=0.1)
+
+
+def _record_stream(data, stream) -> None:
+    '''标记张量被指定的流使用'''
+    if isinstance(data, tc.Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for item in data:
+            _record_stream(item, stream)
+    elif isinstance(data, dict):
+        for item in data.values():
+            _record_stream(item, stream)
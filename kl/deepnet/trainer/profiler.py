@@ -0,0 +1,77 @@
+from typing import Union
+from pathlib import Path
+import contextlib
+
+import torch as tc
+from torch.profiler import ProfilerActivity
+
+
+def build_profiler(output_dir: Union[str, Path],
+                   wait: int = 1,
+                   warmup: int = 1,
+                   active: int = 3,
+                   repeat: int = 1,
+                   record_shapes: bool = True,
+                   profile_memory: bool = True,
+                   with_stack: bool = False,
+                   row_limit: int = 30,
+                   prefix: str = '') -> tc.profiler.profile:
+    '''
+    创建按步调度的性能分析器
+    每个周期跳过wait步，预热warmup步，记录active步，共重复repeat次(0表示一直重复)
+    每次记录结束后在output_dir中写入
+        <prefix>trace_<步数>.json  Chrome trace，可在chrome://tracing或Perfetto中打开
+        <prefix>operators_<步数>.txt  算子耗时表
+        <prefix>memory_<步数>.txt  算子内存分配表(profile_memory=True时)
+    '''
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    activities = [ProfilerActivity.CPU]
+    sort_by = 'self_cpu_time_total'
+    if tc.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+        sort_by = 'self_cuda_time_total'
+
+    def on_trace_ready(prof: tc.profiler.profile):
+        '''导出本次记录的结果'''
+        step = prof.step_num
+        prof.export_chrome_trace(
+            str(output_dir / Path(f'{prefix}trace_{step}.json')))
+
+        averages = prof.key_averages(group_by_input_shape=record_shapes)
+        with open(output_dir / Path(f'{prefix}operators_{step}.txt'),
+                  'w', encoding='utf-8') as fp:
+            fp.write(averages.table(sort_by=sort_by, row_limit=row_limit))
+
+        if profile_memory:
+            with open(output_dir / Path(f'{prefix}memory_{step}.txt'),
+                      'w', encoding='utf-8') as fp:
+                fp.write(averages.table(sort_by='self_cpu_memory_usage',
+                                        row_limit=row_limit))
+
+    return tc.profiler.profile(
+        activities=activities,
+        schedule=tc.profiler.schedule(wait=wait,
+                                      warmup=warmup,
+                                      active=active,
+                                      repeat=repeat),
+        on_trace_ready=on_trace_ready,
+        record_shapes=record_shapes,
+        profile_memory=profile_memory,
+        with_stack=with_stack)
+
+
+def can_pause(profiler: tc.profiler.profile) -> bool:
+    '''是否支持暂停记录(PyTorch 2.3以上)'''
+    return hasattr(profiler, 'toggle_collection_dynamic')
+
+
+@contextlib.contextmanager
+def paused(profiler: tc.profiler.profile):
+    '''暂停记录，期间的计算不出现在当前的记录窗口中'''
+    profiler.toggle_collection_dynamic(False, profiler.activities)
+    try:
+        yield
+    finally:
+        profiler.toggle_collection_dynamic(True, profiler.activities)
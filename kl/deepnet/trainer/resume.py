@@ -0,0 +1,113 @@
+import copy
+import random
+
+import numpy as np
+import torch as tc
+from torch.utils.data import DataLoader
+
+
+def get_rng_state() -> dict:
+    '''
+    获取Python、NumPy、PyTorch的随机数状态
+    只包含张量和基本类型，可以用tc.load(weights_only=True)读取
+    '''
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': {
+            'keys': tc.from_numpy(keys.astype(np.int64)),
+            'pos': int(pos),
+            'has_gauss': int(has_gauss),
+            'cached_gaussian': float(cached_gaussian),
+        },
+        'torch': tc.get_rng_state(),
+    }
+    if tc.cuda.is_available():
+        state['cuda'] = tc.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict) -> None:
+    '''恢复get_rng_state得到的随机数状态'''
+    random.setstate(_to_tuple(state['python']))
+    numpy_state = state['numpy']
+    np.random.set_state(('MT19937',
+                         numpy_state['keys'].numpy().astype(np.uint32),
+                         numpy_state['pos'],
+                         numpy_state['has_gauss'],
+                         numpy_state['cached_gaussian']))
+    tc.set_rng_state(state['torch'])
+    if 'cuda' in state and tc.cuda.is_available():
+        tc.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_tuple(obj):
+    '''保存后元组可能变为列表，递归地还原为元组'''
+    if isinstance(obj, (list, tuple)):
+        return tuple(_to_tuple(item) for item in obj)
+    return obj
+
+
+def _is_state_value(value) -> bool:
+    '''是否是可以保存的状态值'''
+    if isinstance(value, (tc.Tensor, bool, int, float)):
+        return True
+    if isinstance(value, list):
+        return all(isinstance(item, tc.Tensor) for item in value)
+    return False
+
+
+def get_metric_state(metric) -> dict:
+    '''
+    获取精度计算器的累积状态
+    保存所有张量、张量列表和数值类型的属性(包括torchmetrics的状态)
+    '''
+    return {name: copy.deepcopy(value)
+            for name, value in vars(metric).items()
+            if not name.startswith('__') and _is_state_value(value)}
+
+
+def set_metric_state(metric, state: dict) -> None:
+    '''恢复精度计算器的累积状态'''
+    for name, value in state.items():
+        setattr(metric, name, value)
+
+
+class SkipBatchSampler:
+    '''
+    跳过前若干个批的批采样器
+    只跳过索引，不会读取被跳过的数据
+    '''
+
+    def __init__(self, batch_sampler, num_skip: int = 0):
+        self.batch_sampler = batch_sampler
+        self.num_skip = num_skip
+
+    def __iter__(self):
+        for idx, indices in enumerate(self.batch_sampler):
+            if idx < self.num_skip:
+                continue
+            yield indices
+
+    def __len__(self) -> int:
+        return max(len(self.batch_sampler) - self.num_skip, 0)
+
+
+def skip_loader(data_loader: DataLoader, num_skip: int) -> DataLoader:
+    '''
+    构建一个跳过前num_skip个批的数据加载器
+    打乱顺序与原加载器在相同随机数状态下一致
+    '''
+    if data_loader.batch_sampler is None:
+        raise ValueError(
+            'Can not skip batches of a DataLoader without batch_sampler.')
+    return DataLoader(data_loader.dataset,
+                      batch_sampler=SkipBatchSampler(data_loader.batch_sampler,
+                                                     num_skip),
+                      num_workers=data_loader.num_workers,
+                      collate_fn=data_loader.collate_fn,
+                      pin_memory=data_loader.pin_memory,
+                      timeout=data_loader.timeout,
+                      worker_init_fn=data_loader.worker_init_fn,
+                      generator=data_loader.generator,
+                      persistent_workers=data_loader.persistent_workers)
@@ -0,0 +1,287 @@
+from typing import Union, Optional, Callable
+from pathlib import Path
+import os
+import uuid
+
+import numpy as np
+import torch as tc
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, get_worker_info
+
+# 样本的位置
+NOT_CACHED = -1
+ON_DISK = -2
+# 正在被换出，内容尚未写入磁盘，读取时按未缓存处理
+EVICTING = -3
+# 已预留但尚未写入的槽位，不会被换出
+PINNED = tc.iinfo(tc.int64).max
+
+# 统计的列
+_RAM_HIT, _DISK_HIT, _MISS = range(3)
+
+
+class CachedDataset(Dataset):
+    '''
+    解码后样本的缓存
+    第一次读取时调用原数据集解码，结果以uint8保存在共享内存中
+    之后的轮次直接从缓存读取，DataLoader的工作进程之间共享同一份缓存
+    内存超出预算时，按最近最少使用(LRU)把样本转移到磁盘上的内存映射文件
+    只应缓存确定性的部分，随机的数据增强放在transform中，每次读取时执行
+    加锁:
+        所有样本都能放入内存时，样本的槽位固定，读写都不加锁
+        否则只有槽位的分配和位置的更新在锁内，解码、样本的复制和磁盘读写都在锁外
+    '''
+
+    def __init__(self,
+                 dataset,
+                 ram_budget_mb: float = 1024,
+                 spill_dir: Union[str, Path, None] = None,
+                 transform: Optional[Callable] = None,
+                 max_worker: int = 64):
+        '''
+        参数:
+            dataset  原数据集，返回(X, y)或X
+                X可以转换为形状固定的uint8数组，y为整数
+            ram_budget_mb  共享内存的预算(MB)
+            spill_dir  溢出文件的文件夹，None表示超出预算的样本不缓存
+            transform  读取后对X的变换，例如随机裁剪、转换为浮点数
+            max_worker  命中统计按工作进程分开计数，超过时共用计数器(统计可能略少)
+        '''
+        self.dataset = dataset
+        self.transform = transform
+        self.num_sample = len(dataset)
+
+        # 用第一个样本确定形状
+        X, y = self._decode(0)
+        self.sample_shape = tuple(X.shape)
+        self.has_target = y is not None
+        sample_mb = max(X.nbytes, 1) / 1024**2
+        # 内存中的槽位
+        self.num_slot = min(self.num_sample, int(ram_budget_mb // sample_mb))
+        # 所有样本都能放入内存时不会换出，第idx个样本固定在第idx个槽位
+        # 可以直接返回共享内存的视图
+        self.zero_copy = self.num_slot == self.num_sample
+
+        # 共享内存，工作进程读写同一份
+        self._ram = tc.empty((self.num_slot, *self.sample_shape),
+                             dtype=tc.uint8).share_memory_()
+        self._targets = tc.zeros(self.num_sample, dtype=tc.int64).share_memory_()
+        # 每个样本的位置: 槽位号、NOT_CACHED、ON_DISK或EVICTING
+        self._location = tc.full((self.num_sample,), NOT_CACHED,
+                                 dtype=tc.int64).share_memory_()
+        # 每个槽位中的样本和最后使用的时刻
+        self._owner = tc.full((self.num_slot,), -1, dtype=tc.int64).share_memory_()
+        self._last_used = tc.zeros(self.num_slot, dtype=tc.int64).share_memory_()
+        # 已分配的槽位数和时钟
+        self._num_used = tc.zeros(1, dtype=tc.int64).share_memory_()
+        self._clock = tc.zeros(1, dtype=tc.int64).share_memory_()
+        # 每个工作进程一行，只由该进程写入，不需要加锁
+        # 第0行为主进程
+        self._stats = tc.zeros((max_worker+1, 3), dtype=tc.int64).share_memory_()
+        self._lock = mp.Lock()
+
+        # 溢出到磁盘的样本按序号存放
+        # 样本写入后内容不再变化，再次换出时不需要重写
+        self.spill_path = None
+        self._disk = None
+        self._spilled = tc.zeros(self.num_sample, dtype=tc.bool).share_memory_()
+        if spill_dir is not None and self.num_slot < self.num_sample:
+            spill_dir = Path(spill_dir)
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            self.spill_path = spill_dir/Path(f'cache_{uuid.uuid4().hex}.npy')
+            self._disk = np.lib.format.open_memmap(
+                self.spill_path, mode='w+', dtype=np.uint8,
+                shape=(self.num_sample, *self.sample_shape))
+            self._disk_pid = os.getpid()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        # 内存映射在每个进程中重新打开
+        state['_disk'] = None
+        return state
+
+    def _get_disk(self) -> np.memmap:
+        if self._disk is None or self._disk_pid != os.getpid():
+            self._disk = np.load(self.spill_path, mmap_mode='r+')
+            self._disk_pid = os.getpid()
+        return self._disk
+
+    def _decode(self, idx: int) -> tuple:
+        '''调用原数据集，返回uint8数组和标签'''
+        item = self.dataset[idx]
+        y = None
+        if isinstance(item, (tuple, list)):
+            item, y = item[0], item[1]
+            y = int(y)
+        if isinstance(item, tc.Tensor):
+            item = item.numpy()
+        X = np.ascontiguousarray(np.asarray(item))
+        if X.dtype != np.uint8:
+            raise TypeError(f'CachedDataset stores uint8 samples, got {X.dtype}.')
+        return X, y
+
+    def __len__(self) -> int:
+        return self.num_sample
+
+    def _count(self, column: int) -> None:
+        '''在本进程的统计行中计数'''
+        info = get_worker_info()
+        row = 0 if info is None else (info.id+1) % len(self._stats)
+        self._stats[row, column] += 1
+
+    def __getitem__(self, idx: int):
+        X = self._read(idx)
+        if X is not None:
+            y = int(self._targets[idx]) if self.has_target else None
+        else:
+            # 未缓存，解码不占用锁
+            self._count(_MISS)
+            X_np, y = self._decode(idx)
+            if tuple(X_np.shape) != self.sample_shape:
+                raise ValueError(
+                    f'Sample {idx} has shape {X_np.shape}, expected {self.sample_shape}.')
+            X = self._insert(idx, X_np, y)
+        if self.transform is not None:
+            X = self.transform(X)
+        if self.has_target:
+            return X, y
+        return X
+
+    def _read(self, idx: int) -> Optional[tc.Tensor]:
+        '''从缓存读取，未缓存时返回None'''
+        if self.zero_copy:
+            # 槽位固定，样本写完后才发布位置
+            if int(self._location[idx]) < 0:
+                return None
+            self._count(_RAM_HIT)
+            return self._ram[idx]
+
+        with self._lock:
+            location = int(self._location[idx])
+            if location >= 0:
+                self._last_used[location] = self._tick()
+                # 锁外可能被换出，复制一份
+                X = self._ram[location].clone()
+        if location >= 0:
+            self._count(_RAM_HIT)
+            return X
+        if location != ON_DISK:
+            return None
+
+        # 磁盘上的样本内容不会变化，在锁外复制
+        self._count(_DISK_HIT)
+        X = tc.from_numpy(np.array(self._get_disk()[idx]))
+        # 放回内存
+        self._promote(idx, X, expected=ON_DISK)
+        return X
+
+    def _insert(self, idx: int, X: np.ndarray, y: Optional[int]) -> tc.Tensor:
+        '''把新解码的样本放入缓存'''
+        X = tc.from_numpy(X)
+        if y is not None:
+            self._targets[idx] = y
+        if self.zero_copy:
+            # 多个工作进程同时写入时内容相同
+            self._ram[idx] = X
+            self._location[idx] = idx
+            return self._ram[idx]
+        if self.num_slot == 0:
+            # 没有内存预算，直接写入磁盘
+            if self.spill_path is not None:
+                self._get_disk()[idx] = X.numpy()
+                with self._lock:
+                    self._spilled[idx] = True
+                    if int(self._location[idx]) == NOT_CACHED:
+                        self._location[idx] = ON_DISK
+            return X
+        self._promote(idx, X, expected=NOT_CACHED)
+        return X
+
+    def _tick(self) -> int:
+        '''需要持有锁'''
+        self._clock += 1
+        return int(self._clock)
+
+    def _promote(self, idx: int, X: tc.Tensor, expected: int) -> None:
+        '''
+        把样本放入内存槽位，没有空位时换出最近最少使用的样本
+        锁内只分配槽位和更新位置，样本的复制和换出样本的写入在锁外
+        参数:
+            expected  样本当前应处的位置，已被其他工作进程改变时放弃
+        '''
+        # 分配槽位
+        with self._lock:
+            if int(self._location[idx]) != expected:
+                return
+            evicted, evicted_X = -1, None
+            if int(self._num_used) < self.num_slot:
+                slot = int(self._num_used)
+                self._num_used += 1
+            else:
+                slot = int(tc.argmin(self._last_used))
+                if int(self._last_used[slot]) == PINNED:
+                    # 所有槽位都在写入中，不缓存
+                    return
+                evicted = int(self._owner[slot])
+                if self.spill_path is None:
+                    self._location[evicted] = NOT_CACHED
+                elif bool(self._spilled[evicted]):
+                    # 磁盘上已有该样本
+                    self._location[evicted] = ON_DISK
+                else:
+                    self._location[evicted] = EVICTING
+                    evicted_X = self._ram[slot].clone()
+            self._owner[slot] = idx
+            # 写入完成前不会被选中换出
+            self._last_used[slot] = PINNED
+
+        # 锁外复制
+        self._ram[slot] = X
+        if evicted_X is not None:
+            self._get_disk()[evicted] = evicted_X.numpy()
+
+        # 发布位置
+        with self._lock:
+            self._location[idx] = slot
+            self._last_used[slot] = self._tick()
+            if evicted_X is not None:
+                self._spilled[evicted] = True
+                if int(self._location[evicted]) == EVICTING:
+                    self._location[evicted] = ON_DISK
+
+    def reset_stats(self) -> None:
+        '''清零命中统计，每轮开始时调用'''
+        self._stats.zero_()
+
+    def stats(self) -> dict:
+        '''
+        命中统计
+        返回:
+            {'hit_rate', 'ram_hit', 'disk_hit', 'miss', 'num_ram', 'num_disk'}
+        '''
+        ram_hit, disk_hit, miss = self._stats.sum(dim=0).tolist()
+        num_disk = int((self._location == ON_DISK).sum())
+        num_ram = int((self._location >= 0).sum())
+        total = ram_hit + disk_hit + miss
+        return {
+            'hit_rate': (ram_hit + disk_hit) / total if total > 0 else 0.0,
+            'ram_hit': ram_hit,
+            'disk_hit': disk_hit,
+            'miss': miss,
+            'num_ram': num_ram,
+            'num_disk': num_disk,
+        }
+
+    def close(self) -> None:
+        '''删除溢出文件'''
+        self._disk = None
+        if self.spill_path is not None and self.spill_path.exists():
+            self.spill_path.unlink()
+
+
+def find_cache(data_loader) -> Optional[CachedDataset]:
+    '''找到数据加载器使用的CachedDataset，经过Prefetcher包装时也可以'''
+    while hasattr(data_loader, 'data_loader'):
+        data_loader = data_loader.data_loader
+    dataset = getattr(data_loader, 'dataset', None)
+    return dataset if isinstance(dataset, CachedDataset) else None
@@ -4,20 +4,24 @@ import json
 
 from .util import number2string
 
+# 默认记录的数值
+DEFAULT_COLUMNS = ['mode', 'epoch', 'batch',
+                   'loss', 'accuracy', 'time', 'speed',
+                   'data_wait', 'cache_hit_rate']
+# 默认上传到Tensorboard的数值
+DEFAULT_BOARD_COLUMNS = ['loss', 'accuracy']
+
 
 class SummaryManager:
     '''信息管理器'''
-    # 保存的数据
-    storage = []
 
     def __init__(self,
                  root_dir: Union[str, Path, None],
                  # 要记录的数值
-                 columns: list = ['mode', 'epoch', 'batch',
-                                  'loss', 'accuracy', 'time'],
+                 columns: list = DEFAULT_COLUMNS,
                  enable_tensorboard: bool = False,
                  # 要上传到Tensorboard的数值
-                 board_columns: list = ['loss', 'accuracy'],
+                 board_columns: list = DEFAULT_BOARD_COLUMNS,
                  ):
         # 根路径
         # 使用Path对象
@@ -28,6 +32,9 @@ class SummaryManager:
 
         # 需要记录的列名
         self.columns = columns
+        # 保存的数据
+        # 每个实例单独一份，同一进程中的多个训练器互不影响
+        self.storage = []
 
         # 使用Tensorboard图表
         self.enable_tensorboard = enable_tensorboard
@@ -112,11 +119,17 @@ class SummaryManager:
             text_list.append(text)
         return ' '.join(text_list)
 
-    def save(self):
-        '''保存为JSON'''
+    def save(self, storage: Optional[list] = None):
+        '''
+        保存为JSON
+        参数:
+            storage  要保存的记录，默认为当前的全部记录
+        '''
+        if storage is None:
+            storage = self.storage
         path = self.root_dir/Path('summary.json')
         with open(path, mode='w', encoding='utf-8') as fp:
-            json.dump(self.storage,
+            json.dump(storage,
                       fp=fp,
                       indent=4,
                       ensure_ascii=False)
@@ -0,0 +1,229 @@
+from typing import Union, Optional, Callable
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import json
+import math
+import multiprocessing
+import traceback
+
+
+def _trial_score(trainer, metric: str, mode: str, epoch: int) -> Optional[float]:
+    '''记录中不晚于epoch的最后一条指定mode的数值'''
+    score = None
+    for record in trainer.summaryManager.storage:
+        if record.get('mode') == mode and record.get('epoch', 0) <= epoch \
+                and record.get(metric) is not None:
+            score = record[metric]
+    return score
+
+
+def _run_trial(trial_fn: Callable,
+               config: dict,
+               root_dir: str,
+               device,
+               num_epoch: int,
+               metric: str,
+               mode: str) -> dict:
+    '''
+    工作进程中训练一个试验到num_epoch轮
+    文件夹中已有记录时，先从权重管理器加载，继续训练
+    '''
+    trainer = trial_fn(config, Path(root_dir), device)
+    if not trainer.enable_checkpointManager:
+        raise ValueError('Sweep trials require enable_checkpointManager=True.')
+    if trainer.info_fp.exists():
+        trainer.load()
+    # load会恢复上次的num_epoch
+    trainer.num_epoch = num_epoch
+    trainer.fit()
+    return {
+        'epoch': trainer.epoch,
+        'score': _trial_score(trainer, metric, mode, num_epoch),
+        'early_stop': trainer.enable_earlyStop and trainer.earlyStop.status,
+    }
+
+
+class Sweep:
+    '''
+    超参数搜索，异步逐次减半(ASHA)
+    每个配置是一个试验，在进程池中训练
+    预算按轮数分级: min_epoch, min_epoch*eta, min_epoch*eta^2, ..., max_epoch
+    试验训练到某一级后暂停，在该级已完成的试验中排在前1/eta时晋级
+    晋级的试验从权重管理器的记录继续训练到下一级，没有晋级的试验不再训练
+    试验自身的早停触发时，不再晋级
+    '''
+
+    def __init__(self,
+                 trial_fn: Callable,
+                 configs: list,
+                 root_dir: Union[str, Path] = './sweep_output/',
+                 min_epoch: int = 1,
+                 max_epoch: int = 27,
+                 eta: int = 3,
+                 num_worker: int = 2,
+                 devices: Optional[list] = None,
+                 metric: str = 'accuracy',
+                 mode: str = 'test',
+                 maximize: bool = True,
+                 verbose: int = 1):
+        '''
+        参数:
+            trial_fn  创建训练器的函数，调用方式为trial_fn(config, root_dir, device)
+                需要定义在模块的顶层，以便传给工作进程
+                训练器应使用root_dir、createFolderByDate=False，且启用权重管理器
+                num_epoch由搜索器设置
+            configs  每个试验的超参数
+            min_epoch  第一级的轮数
+            max_epoch  最高一级的轮数
+            eta  每一级保留的比例为1/eta
+            num_worker  同时训练的试验数量
+            devices  工作进程使用的设备，依次分配给正在训练的试验
+                默认全部为cpu
+            metric, mode  比较试验使用的记录，例如测试集的accuracy
+            maximize  数值是否越大越好
+        '''
+        if eta < 2:
+            raise ValueError('eta must be at least 2.')
+        self.trial_fn = trial_fn
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.num_worker = num_worker
+        self.devices = list(devices) if devices is not None else ['cpu']*num_worker
+        if len(self.devices) < num_worker:
+            raise ValueError('devices must have at least num_worker entries.')
+        self.metric = metric
+        self.mode = mode
+        self.maximize = maximize
+        self.eta = eta
+        self.verbose = verbose
+
+        # 每一级的轮数
+        self.rungs = []
+        epoch = min_epoch
+        while epoch < max_epoch:
+            self.rungs.append(epoch)
+            epoch *= eta
+        self.rungs.append(max_epoch)
+
+        # 试验的状态
+        # pending  尚未开始
+        # running  训练中
+        # paused  到达某一级，等待晋级
+        # completed  到达最高一级
+        # stopped  试验自身的早停触发
+        # failed  训练出错
+        self.trials = [{'id': idx,
+                        'config': config,
+                        'status': 'pending',
+                        'rung': -1,
+                        'scores': {},
+                        'error': None} for idx, config in enumerate(configs)]
+        self.summary_fp = self.root_dir/Path('sweep.json')
+
+    def _print(self, text, verbose=0):
+        if self.verbose >= verbose:
+            print(text)
+
+    def _rank_key(self, score: Optional[float]) -> float:
+        '''排序用的数值，越大越好，没有记录时最差'''
+        if score is None or math.isnan(score):
+            return -math.inf
+        return score if self.maximize else -score
+
+    def _next_job(self) -> Optional[tuple]:
+        '''
+        选择下一个任务
+        从高到低检查每一级，有可以晋级的试验时优先晋级，否则开始新的试验
+        返回:
+            试验和目标级，没有可做的任务时为None
+        '''
+        for rung in range(len(self.rungs)-2, -1, -1):
+            # 在该级完成的试验，包括已经晋级的
+            finished = [trial for trial in self.trials
+                        if str(self.rungs[rung]) in trial['scores']
+                        and trial['status'] != 'failed']
+            num_promote = len(finished) // self.eta
+            if num_promote == 0:
+                continue
+            finished.sort(key=lambda trial: self._rank_key(
+                trial['scores'][str(self.rungs[rung])]), reverse=True)
+            for trial in finished[:num_promote]:
+                if trial['status'] == 'paused' and trial['rung'] == rung:
+                    return trial, rung+1
+
+        for trial in self.trials:
+            if trial['status'] == 'pending':
+                return trial, 0
+        return None
+
+    def _save(self):
+        with open(self.summary_fp, 'w', encoding='utf-8') as fs:
+            json.dump({'rungs': self.rungs, 'trials': self.trials},
+                      fp=fs,
+                      indent=4,
+                      ensure_ascii=False,
+                      default=str)
+
+    def run(self) -> list:
+        '''
+        运行搜索
+        返回:
+            按最高一级的分数排序的试验
+        '''
+        ctx = multiprocessing.get_context('spawn')
+        free_devices = list(self.devices[:self.num_worker])
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.num_worker, mp_context=ctx) as pool:
+            while True:
+                # 填满空闲的工作进程
+                while len(running) < self.num_worker:
+                    job = self._next_job()
+                    if job is None:
+                        break
+                    trial, rung = job
+                    trial['status'] = 'running'
+                    device = free_devices.pop()
+                    future = pool.submit(
+                        _run_trial, self.trial_fn, trial['config'],
+                        str(self.root_dir/Path('trial{}'.format(trial['id']))),
+                        device, self.rungs[rung], self.metric, self.mode)
+                    running[future] = (trial, rung, device)
+                    self._print('Trial {} -> Epoch {}'.format(
+                        trial['id'], self.rungs[rung]), verbose=1)
+                if len(running) == 0:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial, rung, device = running.pop(future)
+                    free_devices.append(device)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        trial['status'] = 'failed'
+                        trial['error'] = traceback.format_exc()
+                        self._print('Trial {} failed.'.format(trial['id']), verbose=1)
+                        continue
+                    trial['rung'] = rung
+                    trial['scores'][str(self.rungs[rung])] = result['score']
+                    if result['early_stop']:
+                        trial['status'] = 'stopped'
+                    elif rung == len(self.rungs)-1:
+                        trial['status'] = 'completed'
+                    else:
+                        trial['status'] = 'paused'
+                    self._print('Trial {} Epoch {}: {}={}'.format(
+                        trial['id'], self.rungs[rung], self.metric, result['score']),
+                        verbose=1)
+                self._save()
+
+        # 没有晋级的试验被剪枝
+        for trial in self.trials:
+            if trial['status'] == 'paused':
+                trial['status'] = 'pruned'
+        self._save()
+        return sorted(self.trials, key=lambda trial: (
+            trial['rung'],
+            self._rank_key(trial['scores'].get(str(self.rungs[trial['rung']]))
+                           if trial['rung'] >= 0 else None)),
+            reverse=True)
@@ -0,0 +1,103 @@
+from typing import Optional
+import math
+import time
+
+import torch as tc
+
+
+# 训练步的各个阶段
+PHASES = ('data', 'forward', 'loss', 'backward', 'optimizer', 'metric')
+# 统计的分位数
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values: list, q: float) -> float:
+    '''最近秩法求分位数，values应已排序'''
+    if len(values) == 0:
+        return 0.0
+    rank = math.ceil(q / 100 * len(values))
+    return values[min(max(rank-1, 0), len(values)-1)]
+
+
+class StepTimer:
+    '''
+    分阶段计时器
+    用perf_counter_ns记录每一步中数据等待、前向、损失、反向、优化器、精度更新的耗时
+    每轮结束时汇总为分位数(毫秒)
+    '''
+
+    def __init__(self, device: Optional[tc.device] = None):
+        # CUDA的计算是异步的，计时前需要同步
+        self.synchronize = device is not None and tc.device(device).type == 'cuda'
+        self.reset()
+
+    @staticmethod
+    def get_columns() -> list:
+        '''汇总结果的键名'''
+        return ['time_{}_p{}'.format(phase, q)
+                for phase in PHASES + ('step',)
+                for q in PERCENTILES]
+
+    def reset(self) -> None:
+        '''开始新的一轮'''
+        # 每一步各阶段的耗时
+        self.records = {phase: [] for phase in PHASES + ('step',)}
+        # 当前步各阶段的累计耗时
+        self.current = dict.fromkeys(PHASES, 0)
+        self.time_last = time.perf_counter_ns()
+
+    def start(self) -> None:
+        '''开始计时，之前的时间不计入任何阶段'''
+        if self.synchronize:
+            tc.cuda.synchronize()
+        self.time_last = time.perf_counter_ns()
+
+    def mark(self, phase: str) -> None:
+        '''上次计时至今的时间计入phase阶段'''
+        if self.synchronize:
+            tc.cuda.synchronize()
+        now = time.perf_counter_ns()
+        self.current[phase] += now - self.time_last
+        self.time_last = now
+
+    def end_step(self) -> None:
+        '''结束一步(一个逻辑批)'''
+        total = 0
+        for phase in PHASES:
+            self.records[phase].append(self.current[phase])
+            total += self.current[phase]
+            self.current[phase] = 0
+        self.records['step'].append(total)
+
+    def summary(self) -> dict:
+        '''本轮的分位数(毫秒)'''
+        result = {}
+        for phase, values in self.records.items():
+            values = sorted(values)
+            for q in PERCENTILES:
+                result['time_{}_p{}'.format(phase, q)] = \
+                    percentile(values, q) / 1e6
+        return result
+
+
+class NullTimer:
+    '''不计时，所有方法均为空操作'''
+
+    @staticmethod
+    def get_columns() -> list:
+        return []
+
+    def reset(self) -> None:
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def mark(self, phase: str) -> None:
+        pass
+
+    def end_step(self) -> None:
+        pass
+
+    def summary(self) -> dict:
+        return {}
@@ -1,16 +1,33 @@
 import os
 from pathlib import Path
 
-from typing import Union, Optional
+from typing import Union, Optional, Literal
 
+import contextlib
+import functools
 import json
+import math
 import time
 
 import torch as tc
+from torch.nn.parallel import DistributedDataParallel
 
 from .early_stop import EarlyStop
-from .checkpoint_manager import CheckpointManager
-from .summary_manager import SummaryManager
+from .checkpoint_manager import CheckpointManager, snapshot_to_cpu
+from .summary_manager import SummaryManager, DEFAULT_COLUMNS, DEFAULT_BOARD_COLUMNS
+from .precision import PrecisionManager
+from .prefetcher import Prefetcher, move_to_device
+from .timing import StepTimer, NullTimer, PHASES
+from .profiler import build_profiler, can_pause, paused
+from .evaluator import AsyncEvaluator
+from .inference import OutputWriter, rebatch_loader
+from .batch_finder import find_batch_size, search_batch_size, default_memory_limit_mb
+from .sample_cache import find_cache
+from .compiler import compile_module, compile_function, BufferSnapshot
+from .resume import (get_rng_state, set_rng_state,
+                     get_metric_state, set_metric_state, skip_loader)
+from .util import split_batch, loader_layout
+from . import distributed as dist_util
 
 
 class Trainer:
@@ -31,9 +48,22 @@ class Trainer:
                  checkpoint_limit: int = 3,
                  device: str = 'cpu',
                  enable_tensorboard: bool = False,
-                 earlyStop_config: Optional[dict] = None):
+                 earlyStop_config: Optional[dict] = None,
+                 precision: Literal['fp32', 'bf16', 'fp16'] = 'fp32',
+                 accumulation_config: Optional[dict] = None,
+                 sync_interval: int = 1,
+                 prefetch_config: Optional[dict] = None,
+                 distributed: bool = False,
+                 compile_config: Optional[dict] = None,
+                 checkpoint_interval: Optional[int] = None,
+                 checkpoint_config: Optional[dict] = None,
+                 enable_timing: bool = False,
+                 profiler_config: Optional[dict] = None,
+                 eval_config: Optional[dict] = None):
         # 网络
         self.net = net
+        # 未经包装的网络，用于保存和加载权重
+        self.raw_net = net
         # 损失函数
         self.loss_fn = loss_fn
         # 优化器
@@ -59,8 +89,54 @@ class Trainer:
         else:
             self.device = tc.device(device)
 
+        # 多进程数据并行
+        # 需要在launch启动的进程中使用
+        self.distributed = distributed
+        if self.distributed:
+            if not dist_util.is_distributed():
+                raise RuntimeError(
+                    'distributed=True requires an initialized process group, '
+                    'start the training with kl.deepnet.trainer.distributed.launch.')
+            # 每个进程只读取数据集的一个分片
+            self.data_train_loader = dist_util.distributed_loader(
+                self.data_train_loader)
+            if self.enable_test:
+                self.data_test_loader = dist_util.distributed_loader(
+                    self.data_test_loader, shuffle=False)
+            # 梯度在反向传播时自动同步
+            self.net = self.ddp_net = DistributedDataParallel(
+                self.net,
+                device_ids=[self.device] if self.device.type == 'cuda' else None)
+        # 进程序号
+        self.rank = dist_util.get_rank()
+        self.world_size = dist_util.get_world_size()
+        # 只有主进程负责打印和写文件
+        self.is_main = self.rank == 0
+
+        # 后台预取数据
+        # num_prefetch  提前准备的批数量
+        # pin_memory  是否使用锁页内存(CUDA)
+        # use_stream  是否在独立的流上复制数据(CUDA)
+        if isinstance(prefetch_config, dict):
+            self.data_train_loader = Prefetcher(
+                self.data_train_loader, device=self.device, **prefetch_config)
+            if self.enable_test:
+                self.data_test_loader = Prefetcher(
+                    self.data_test_loader, device=self.device, **prefetch_config)
+
+        # 计算精度
+        # fp32  全精度
+        # bf16  bfloat16自动混合精度
+        # fp16  float16自动混合精度+梯度缩放
+        self.precision = precision
+        self.precisionManager = PrecisionManager(
+            precision=precision,
+            device=self.device)
+
         # 当前轮次
         self.epoch = 1
+        # 当前轮中已完成的加载批数量，在轮中保存时使用
+        self.batch = 0
         # 总轮次
         self.num_epoch = num_epoch
         # 批大小
@@ -70,12 +146,25 @@ class Trainer:
         if self.enable_test:
             self.num_batch_test = len(self.data_test_loader)
 
+        # 梯度累积
+        # num_step  每个逻辑批由多少个加载批累积而成
+        # num_split  每个加载批拆分为多少个微批
+        # 逻辑批大小 = 加载批大小*num_step，每个微批的大小 = 加载批大小/num_split
+        accumulation_config = accumulation_config or {}
+        self.num_accumulation_step = accumulation_config.get('num_step', 1)
+        self.num_micro_batch = accumulation_config.get('num_split', 1)
+        if self.num_accumulation_step < 1 or self.num_micro_batch < 1:
+            raise ValueError(
+                'num_step and num_split in accumulation_config should be >= 1.')
+
         # 根目录
         self.roor_dir = Path(roor_dir)
         # 是否在根目录下创建子文件夹
         # 由当前时间命名
         if createFolderByDate:
             current_time = time.strftime('%Y-%m-%d+%H-%M-%S', time.localtime())
+            # 所有进程使用主进程的时间，保证文件夹一致
+            current_time = dist_util.broadcast_object(current_time)
             self.roor_dir = self.roor_dir/Path(current_time)
         # 创建文件夹
         self.roor_dir.mkdir(parents=True, exist_ok=True)
@@ -86,27 +175,86 @@ class Trainer:
         # 0  不记录任何信息
         # 1  只记录批信息
         # 2  记录轮信息、批信息
-        self.verbose = verbose
+        # 非主进程不打印
+        self.verbose = verbose if self.is_main else 0
+        # 每隔多少个逻辑批取出一次损失和精度用于打印
+        # 取值会触发设备同步和精度的规约，间隔越大开销越小
+        # 只在verbose>=2时生效，本轮结束时总会取值
+        self.sync_interval = max(sync_interval, 1)
+
+        # ==============================================
+        # 编译网络
+        # backend  编译后端，torchscript或tc.compile的后端(inductor、aot_eager等)
+        # mode  tc.compile的模式
+        # compile_step  是否把前向计算和损失一起编译
+        # num_warmup  预热的次数，编译在预热时完成，不计入训练时间
+        # 编译在fit开始时进行，失败时回退到eager模式
+        self.compile_config = compile_config
+        self.is_compiled = False
+        # 实际使用的后端和编译耗时
+        self.compile_backend = 'eager'
+        self.compile_time = 0.0
+        # 前向计算和损失，编译后会被替换
+        self._forward_loss_fn = self._forward_loss
+        # 当前微批的损失权重(占逻辑批的样本比例)
+        self._micro_weight = 1.0
+
+        # ==============================================
+        # 分阶段计时
+        # 记录每步中数据等待、前向、损失、反向、优化器、精度更新的耗时
+        # 每轮汇总为分位数，写入记录和Tensorboard
+        self.enable_timing = enable_timing
+        self.timer = StepTimer(self.device) if enable_timing else NullTimer()
+
+        # ==============================================
+        # 性能分析
+        # wait/warmup/active/repeat  分析的步数调度，参见tc.profiler.schedule
+        # record_shapes/profile_memory/with_stack  记录的内容
+        # 结果写入根目录下的profiler文件夹
+        # 不使用时每步只有一次判断，没有额外开销
+        self.profiler_config = profiler_config
+        self.profiler = None
 
         # ==============================================
         # 信息管理器
+        board_columns = DEFAULT_BOARD_COLUMNS
+        if self.enable_timing:
+            board_columns = board_columns + ['speed'] + self.timer.get_columns()
         self.summaryManager = SummaryManager(
             root_dir=self.roor_dir/Path('summary'),
-            enable_tensorboard=enable_tensorboard)
+            columns=DEFAULT_COLUMNS + self.timer.get_columns(),
+            enable_tensorboard=enable_tensorboard and self.is_main,
+            board_columns=board_columns)
 
         # ==============================================
         # 权重管理器
         self.enable_checkpointManager = enable_checkpointManager
         if self.enable_checkpointManager:
+            modObj = {
+                'net': self.raw_net,
+                'loss_fn': self.loss_fn,
+                'optimizer': self.optimizer
+            }
+            if self.precisionManager.scaler is not None:
+                # 梯度缩放器的状态
+                modObj['scaler'] = self.precisionManager
             # 权重管理器
+            # checkpoint_config为CheckpointManager的其他参数
+            # 例如{'async_write': True, 'max_pending': 2}
             self.checkpointManager = CheckpointManager(
-                modObj={
-                    'net': self.net,
-                    'loss_fn': self.loss_fn,
-                    'optimizer': self.optimizer
-                },
+                modObj=modObj,
                 max_count=checkpoint_limit,
-                root_dir=self.roor_dir/Path('checkpoint'))
+                root_dir=self.roor_dir/Path('checkpoint'),
+                **(checkpoint_config or {}))
+
+        # 每隔多少个逻辑批在轮中保存一次
+        # 同时保存随机数状态、数据位置和累积的精度，可以从下一个批继续训练
+        self.checkpoint_interval = checkpoint_interval
+        if self.checkpoint_interval is not None and not self.enable_checkpointManager:
+            raise ValueError(
+                'checkpoint_interval requires enable_checkpointManager=True.')
+        # 轮中断点的状态，由load设置
+        self._resume_state = None
 
         # ==============================================
         # 早停功能
@@ -119,6 +267,23 @@ class Trainer:
                 **earlyStop_config)
             # 指定早停要监视的对象
             self.earlyStop_aim = earlyStop_config.get('object', 'loss')
+            # 监视训练(train)还是测试(test)的结果
+            self.earlyStop_mode = earlyStop_config.get('mode', 'train')
+
+        # ==============================================
+        # 异步测试
+        # 每轮训练结束后，测试在独立的进程中用权重快照进行，训练直接开始下一轮
+        # device  测试进程使用的设备，默认与训练相同
+        # max_lag  训练最多领先测试多少轮，0表示等待每轮测试完成
+        # 测试结果取回后记入信息管理器，并用于早停
+        self.eval_config = eval_config
+        self.evaluator = None
+        if self.eval_config is not None:
+            if not self.enable_test:
+                raise ValueError('eval_config requires data_test_loader.')
+            if self.distributed:
+                raise ValueError(
+                    'eval_config can not be used with distributed=True.')
 
     def predict(self, data: tc.tensor):
         '''
@@ -133,12 +298,37 @@ class Trainer:
         Y = self.net(X)
         return Y, Y_true
 
+    def _forward_loss(self, data, mark: bool = True):
+        '''
+        前向计算和损失
+        参数:
+            mark  是否单独记录前向计算的耗时，编译时不能记录
+        '''
+        with self.precisionManager.autocast():
+            # 预测
+            Y, Y_true = self.predict(data)
+            if mark:
+                self.timer.mark('forward')
+            # 损失
+            loss = self.loss_fn(Y, Y_true)
+        return Y, Y_true, loss
+
+    def _record_loss(self, loss):
+        '''用于显示和记录的损失，默认与反向传播的损失相同'''
+        return loss
+
     def update_metric(self, Y, Y_true):
-        '''更新精度'''
+        '''
+        更新精度的累积状态
+        不做规约，不会触发设备同步
+        '''
         with tc.no_grad():
             _ = self.metric.update(Y, Y_true)
-            acc = self.metric.compute()
-        return acc
+
+    def compute_metric(self):
+        '''计算当前累积的精度'''
+        with tc.no_grad():
+            return self.metric.compute()
 
     def _fit_batch(self, is_training: bool = True):
         if is_training:
@@ -146,73 +336,352 @@ class Trainer:
             self.net.train()
             # 数据加载器
             data_loder = self.data_train_loader
+            # 每个逻辑批包含的加载批数量
+            num_step = self.num_accumulation_step
+            # 每轮的样本数和批大小，用于计算逻辑批的样本总数
+            layout = loader_layout(data_loder)
+            if self.distributed:
+                # 每轮使用不同的打乱顺序
+                data_loder.sampler.set_epoch(self.epoch)
+            # 轮中断点
+            resume_state = self._resume_state
+            self._resume_state = None
         else:
             # 测试模式
             self.net.eval()
             data_loder = self.data_test_loader
+            # 测试时不需要累积
+            num_step = 1
+            layout = None
+            resume_state = None
+        # 加载批的数量
+        num_batch = self.num_batch_train if is_training else self.num_batch_test
+        # 逻辑批的数量
+        num_logical_batch = math.ceil(num_batch / num_step)
 
         # 精度计算器重置
         _ = self.metric.reset()
+        # 样本缓存的命中统计按轮计算
+        cache = find_cache(data_loder)
+        if cache is not None:
+            cache.reset_stats()
+        # 计时器重置
+        self.timer.reset()
+        # 本轮损失的累加值
+        # 保留在设备上，只在需要显示时才取出
+        loss_sum = tc.zeros((), device=self.device)
+
+        # 是否逐批打印
+        # 不打印时跳过所有的同步和格式化
+        show_batch = self.verbose >= 2
+
+        # 本轮的样本数
+        num_sample = 0
+        # 已跳过的批数量
+        num_skip = 0
+
+        if resume_state is None:
+            # 本轮开始时的随机数状态，决定了数据的打乱顺序
+            self._epoch_rng_state = get_rng_state()
+        else:
+            # 从轮中断点继续
+            # 恢复本轮开始时的随机数状态，使打乱顺序与中断前一致
+            self._epoch_rng_state = resume_state['epoch_rng_state']
+            set_rng_state(self._epoch_rng_state)
+            # 跳过已经训练过的批，不读取这些数据
+            num_skip = resume_state['batch']
+            data_loder = self._skip_batches(data_loder, num_skip)
+            # 恢复累积的损失、精度和样本数
+            loss_sum += resume_state['loss_sum'].to(self.device)
+            set_metric_state(self.metric, resume_state['metric_state'])
+            num_sample = resume_state['num_sample']
+
+        # 本轮计时
+        time_epoch_begin = time.time()
 
         # 遍历数据集
-        for batch, data in enumerate(data_loder):
+        for batch, data in enumerate(self._iter_data(data_loder),
+                                     start=num_skip):
             self.batch = batch+1
-            # 计时
-            time_batch_begin = time.time()
+            if resume_state is not None and batch == num_skip:
+                # 打乱顺序已经确定，恢复中断时的随机数状态
+                set_rng_state(resume_state['rng_state'])
+            # 在当前逻辑批中的位置
+            idx_in_group = batch % num_step
+            if idx_in_group == 0:
+                # 逻辑批开始
+                # 计时
+                time_batch_begin = time.time()
+                # 本逻辑批实际包含的加载批数量(最后一个可能不满)
+                num_in_group = min(num_step, num_batch-batch)
+                # 本逻辑批的样本总数(最后一个加载批可能不满)
+                if layout is not None:
+                    num_sample_epoch, loader_batch_size = layout
+                    group_size = min(num_in_group*loader_batch_size,
+                                     num_sample_epoch - batch*loader_batch_size)
+                else:
+                    # 无法确定时假设各加载批的大小相同
+                    group_size = len(data[0]) * num_in_group
+                # 本逻辑批的输出，用于更新精度
+                Y_list, Y_true_list = [], []
+                # 本逻辑批的损失
+                loss = 0
+                if is_training:
+                    # 梯度归零
+                    self.optimizer.zero_grad()
+
+            # 拆分为微批
+            micro_datas = split_batch(data, self.num_micro_batch)
+            for idx_micro, micro_data in enumerate(micro_datas):
+                if is_training:
+                    # 只在逻辑批的最后一个微批同步梯度
+                    is_last_micro = idx_in_group+1 == num_in_group and \
+                        idx_micro+1 == len(micro_datas)
+                    # 按微批占逻辑批的样本比例加权，使梯度与整批计算时一致
+                    # 微批和加载批的大小可能不相等，例如10个样本拆分为4、4、2
+                    self._micro_weight = len(micro_data[0]) / max(group_size, 1)
+                    with self._grad_sync_context(is_last_micro):
+                        # 预测和损失
+                        Y, Y_true, micro_loss = self._forward_loss_fn(
+                            micro_data)
+                        self.timer.mark('loss')
+                        micro_loss = micro_loss * self._micro_weight
+                        # 计算梯度(累积)
+                        self.precisionManager.backward(micro_loss)
+                        self.timer.mark('backward')
+                    loss = loss + self._record_loss(micro_loss.detach())
+                else:
+                    with tc.no_grad(), self.precisionManager.autocast():
+                        # 预测
+                        Y, Y_true = self.predict(micro_data)
+                    self.timer.mark('forward')
+                Y_list.append(Y.detach())
+                Y_true_list.append(Y_true)
+                num_sample += len(Y_true)
+
+            if idx_in_group+1 < num_in_group:
+                # 逻辑批尚未结束
+                continue
 
             if is_training:
-                # 梯度归零
-                self.optimizer.zero_grad()
-                # 预测
-                Y, Y_true = self.predict(data)
-                # 损失
-                loss = self.loss_fn(Y, Y_true)
-                # 计算梯度
-                _ = loss.backward()
                 # 更新权重
-                self.optimizer.step()
-            else:
-                with tc.no_grad():
-                    # 预测
-                    Y, Y_true = self.predict(data)
+                self.precisionManager.step(self.optimizer)
+                loss_sum += loss
+                self.timer.mark('optimizer')
 
             # 更新精度
-            acc = self.update_metric(Y, Y_true)
+            self.update_metric(tc.cat(Y_list), tc.cat(Y_true_list))
+            self.timer.mark('metric')
+            self.timer.end_step()
 
-            # 计时
-            time_batch_delta = time.time() - time_batch_begin
+            if is_training and self.profiler is not None:
+                # 推进分析器的调度
+                self.profiler.step()
 
-            # 打印
-            self._print(
-                text='\r{} Epoch:{}-Batch:{}/{}, {}Accuracy:{:.4f}, Time:{:.6f}'.format(
-                    'Train' if is_training else 'Test',
-                    self.epoch,
-                    self.batch,
-                    self.num_batch_train if is_training else self.num_batch_test,
-                    'Loss:{:.4f}, '.format(loss.item()) if is_training else '',
-                    acc.item(),
-                    time_batch_delta,
-                ),
-                end='', verbose=2)
+            # 已完成的逻辑批数量
+            step = batch // num_step + 1
+
+            if is_training and self.checkpoint_interval is not None \
+                    and step % self.checkpoint_interval == 0 \
+                    and step < num_logical_batch:
+                # 轮中保存
+                # 每个进程的累积状态和随机数状态不同，收集到主进程后按进程序号保存
+                rank_states = dist_util.gather_object(snapshot_to_cpu({
+                    'batch': batch+1,
+                    'epoch_rng_state': self._epoch_rng_state,
+                    'rng_state': get_rng_state(),
+                    'loss_sum': loss_sum.detach(),
+                    'metric_state': get_metric_state(self.metric),
+                    'num_sample': num_sample,
+                }))
+                self.save(resume_state={
+                    'world_size': self.world_size,
+                    'ranks': rank_states,
+                } if self.is_main else None)
+            if show_batch and (step % self.sync_interval == 0
+                               or step == num_logical_batch):
+                # 计时
+                time_batch_delta = time.time() - time_batch_begin
+                # 打印
+                # 显示本轮至今的平均损失和累积精度
+                self._print(
+                    text='\r{} Epoch:{}-Batch:{}/{}, {}Accuracy:{:.4f}, Time:{:.6f}'.format(
+                        'Train' if is_training else 'Test',
+                        self.epoch,
+                        step,
+                        num_logical_batch,
+                        'Loss:{:.4f}, '.format(
+                            loss_sum.item()/step) if is_training else '',
+                        self.compute_metric().item(),
+                        time_batch_delta,
+                    ),
+                    end='', verbose=2)
         # 补充换行符
         self._print('', end='\n', verbose=2)
 
+        # 本轮结束时才规约
+        acc = self.compute_metric()
+        loss = loss_sum / max(num_logical_batch, 1)
+
+        # 本轮耗时
+        time_epoch_delta = time.time() - time_epoch_begin
+
         # 本轮训练结果报表
+        # 分布式训练时取所有进程的平均值，样本数取总和
         epoch_info = {
             'epoch': self.epoch,
             'mode': 'train' if is_training else 'test',
-            'loss': loss.item() if is_training else None,
-            'accuracy': acc.item()
+            'loss': dist_util.all_reduce(loss) if is_training else None,
+            'accuracy': dist_util.all_reduce(acc),
+            'time': time_epoch_delta,
+            # 吞吐量(样本/秒)
+            'speed': dist_util.all_reduce(num_sample, op='sum') / max(time_epoch_delta, 1e-9),
+            # 等待数据的时间
+            'data_wait': dist_util.all_reduce(self.data_wait_time)
         }
+        # 各阶段耗时的分位数
+        epoch_info.update(self.timer.summary())
+        if cache is not None:
+            # 样本缓存的命中率
+            cache_stats = cache.stats()
+            epoch_info['cache_hit_rate'] = dist_util.all_reduce(cache_stats['hit_rate'])
+            self._print(
+                'Cache Hit Rate:{:.4f}, RAM Hit:{}, Disk Hit:{}, Miss:{}'.format(
+                    epoch_info['cache_hit_rate'], cache_stats['ram_hit'],
+                    cache_stats['disk_hit'], cache_stats['miss']),
+                verbose=2)
+        self._print(
+            'Time:{:.2f}s, Data Wait:{:.2f}s, Speed:{:.1f} samples/s, Precision:{}'.format(
+                epoch_info['time'], epoch_info['data_wait'],
+                epoch_info['speed'], self.precision),
+            verbose=2)
+        if self.enable_timing:
+            # 各阶段耗时的中位数
+            self._print(
+                'Median(ms) ' + ', '.join(
+                    '{}:{:.3f}'.format(phase.title(),
+                                       epoch_info[f'time_{phase}_p50'])
+                    for phase in PHASES + ('step',)),
+                verbose=2)
+
+        return epoch_info
 
+    def _record_epoch(self, epoch_info: dict):
+        '''记录一轮的结果，并更新早停'''
         # 记录轮信息
         self.summaryManager.append(
             input=epoch_info)
 
-        if self.enable_earlyStop and is_training:
+        if self.enable_earlyStop and epoch_info['mode'] == self.earlyStop_mode:
             # 更新早停记录器
             self.earlyStop.update(epoch_info[self.earlyStop_aim])
 
+    def _collect_eval(self, drain: bool = False):
+        '''
+        取回异步测试的结果
+        参数:
+            drain  是否等待所有测试完成，否则只等待到领先的轮数不超过max_lag
+        '''
+        if drain:
+            results = self.evaluator.drain()
+        else:
+            results = self.evaluator.collect(block=True)
+        for epoch_info in results:
+            self._print(
+                'Test Epoch:{} Accuracy:{:.4f}, Time:{:.2f}s'.format(
+                    epoch_info['epoch'], epoch_info['accuracy'],
+                    epoch_info['time']),
+                verbose=1)
+            self._record_epoch(epoch_info)
+
+    def _compile(self):
+        '''编译网络并预热，失败时回退到eager模式'''
+        backend = self.compile_config.get('backend', 'inductor')
+        mode = self.compile_config.get('mode', None)
+        eager_net = self.net
+
+        time_begin = time.perf_counter()
+        try:
+            self.net = compile_module(self.net, backend=backend, mode=mode)
+            if self.compile_config.get('compile_step', False):
+                # 前向计算和损失作为整体编译，耗时都计入loss阶段
+                self._forward_loss_fn = functools.partial(
+                    compile_function(self._forward_loss,
+                                     backend=backend, mode=mode),
+                    mark=False)
+            # tc.compile在第一次调用时才真正编译
+            self._warmup(self.compile_config.get('num_warmup', 1))
+            self.compile_backend = backend
+        except Exception as error:
+            # 回退
+            self.net = eager_net
+            self._forward_loss_fn = self._forward_loss
+            self.compile_backend = 'eager'
+            self._print(
+                f'Compile with backend "{backend}" failed, fall back to eager mode: {error}',
+                verbose=1)
+        self.compile_time = time.perf_counter() - time_begin
+        self.is_compiled = True
+
+        self._print(
+            'Compile Time:{:.2f}s, Backend:{}'.format(
+                self.compile_time, self.compile_backend),
+            verbose=1)
+
+    def _warmup(self, num_warmup: int = 1):
+        '''
+        用第一个批预热训练和测试的计算图
+        结束后还原缓冲区、梯度和随机数状态，不影响正式训练
+        '''
+        rng_state = tc.get_rng_state()
+        snapshot = BufferSnapshot(self.raw_net)
+        try:
+            data = next(iter(self.data_train_loader))
+            # 与正式训练时的微批形状一致
+            micro_data = split_batch(data, self.num_micro_batch)[0]
+            for _ in range(num_warmup):
+                self.net.train()
+                _, _, loss = self._forward_loss_fn(micro_data)
+                self.precisionManager.backward(loss)
+                self.optimizer.zero_grad()
+
+                if self.enable_test:
+                    self.net.eval()
+                    with tc.no_grad(), self.precisionManager.autocast():
+                        _ = self.predict(micro_data)
+        finally:
+            self.optimizer.zero_grad()
+            snapshot.restore()
+            tc.set_rng_state(rng_state)
+
+    def _skip_batches(self, data_loader, num_skip: int):
+        '''跳过数据加载器的前num_skip个批'''
+        if isinstance(data_loader, Prefetcher):
+            return data_loader.replace_loader(
+                skip_loader(data_loader.data_loader, num_skip))
+        return skip_loader(data_loader, num_skip)
+
+    def _grad_sync_context(self, enable_sync: bool = True):
+        '''分布式训练时，梯度累积的中间微批不需要同步梯度'''
+        if self.distributed and not enable_sync:
+            return self.ddp_net.no_sync()
+        return contextlib.nullcontext()
+
+    def _iter_data(self, data_loader):
+        '''遍历数据加载器，同时统计等待数据的总时间'''
+        self.data_wait_time = 0.0
+        data_iter = iter(data_loader)
+        while True:
+            self.timer.start()
+            time_begin = time.perf_counter()
+            try:
+                data = next(data_iter)
+            except StopIteration:
+                return
+            self.data_wait_time += time.perf_counter() - time_begin
+            self.timer.mark('data')
+            yield data
+
     def _print(self, text, verbose=0, *args, **kwargs):
         '''
         根据verbose等级打印信息
@@ -224,10 +693,11 @@ class Trainer:
             print(text, *args, **kwargs)
 
     def load(self):
+        extra = None
         # 保存权重
         if self.enable_checkpointManager:
             # 加载权重
-            self.checkpointManager.load()
+            extra = self.checkpointManager.load()
             self._print('Load checkpoint finish.', verbose=1)
             # 加载记录
             self.summaryManager.load()
@@ -240,24 +710,127 @@ class Trainer:
             if attr in info and hasattr(self, attr):
                 setattr(self, attr, info[attr])
 
-    def save(self):
-        # 保存权重
-        if self.enable_checkpointManager:
-            # 自动调用权重保存
-            self.checkpointManager.save()
-            # 保存记录
-            self.summaryManager.save()
+        extra = extra or {}
+        if self.enable_earlyStop and 'early_stop' in extra:
+            # 恢复早停状态
+            for attr, value in extra['early_stop'].items():
+                setattr(self.earlyStop, attr, value)
+
+        if info.get('mid_epoch', False) and 'resume' in extra:
+            # 在轮中保存，从下一个批继续
+            resume_state = extra['resume']
+            if 'ranks' in resume_state:
+                # 每个进程恢复自己的状态
+                if resume_state['world_size'] != self.world_size:
+                    raise ValueError(
+                        'Mid-epoch checkpoint was saved with {} processes, got {}.'.format(
+                            resume_state['world_size'], self.world_size))
+                resume_state = resume_state['ranks'][self.rank]
+            self._resume_state = resume_state
+            self._print(
+                f'Resume from epoch {self.epoch} batch {self.batch}.', verbose=1)
+        else:
+            # 上一轮已经完成，从下一轮开始
+            self.epoch += 1
+
+    def save(self, resume_state: Optional[dict] = None):
+        '''
+        保存权重、记录和训练信息
+        参数:
+            resume_state  在轮中保存时，继续训练所需的状态
+        '''
+        if not self.is_main:
+            # 只有主进程写文件
+            return
 
         # 训练信息
         info = {attr: getattr(self, attr) for attr in [
-            'epoch', 'batch', 'num_epoch']}
-        with open(self.info_fp, 'w', encoding='utf-8') as fs:
+            'epoch', 'batch', 'num_epoch', 'precision',
+            'compile_backend', 'compile_time']}
+        # 是否在轮中保存
+        info['mid_epoch'] = resume_state is not None
+
+        if not self.enable_checkpointManager:
+            self._write_info(info)
+            return
+
+        # 保存权重
+        extra = {}
+        if resume_state is not None:
+            extra['resume'] = resume_state
+        if self.enable_earlyStop:
+            extra['early_stop'] = {attr: getattr(self.earlyStop, attr)
+                                   for attr in ['best_score', 'counter', 'status']}
+        # 记录和训练信息在权重写完之后才写入
+        # 异步写入时中途退出，训练信息不会指向尚未写完的权重
+        storage = list(self.summaryManager.storage)
+
+        def on_written():
+            self.summaryManager.save(storage=storage)
+            self._write_info(info)
+        self.checkpointManager.save(extra=extra, on_written=on_written)
+
+    def _write_info(self, info: dict):
+        '''写入训练信息，先写临时文件再替换'''
+        tmp_fp = self.info_fp.with_suffix('.json.tmp')
+        with open(tmp_fp, 'w', encoding='utf-8') as fs:
             json.dump(info,
                       fp=fs,
                       indent=4,
                       ensure_ascii=False)
+        os.replace(tmp_fp, self.info_fp)
 
     def fit(self):
+        if self.compile_config is not None and not self.is_compiled:
+            # 编译和预热不计入训练时间
+            self._compile()
+
+        if self.profiler_config is not None:
+            # 每个进程写入各自的文件
+            self.profiler = build_profiler(
+                output_dir=self.roor_dir/Path('profiler'),
+                prefix=f'rank{self.rank}_' if self.distributed else '',
+                **self.profiler_config)
+            self.profiler.start()
+
+        if self.eval_config is not None:
+            # 测试进程在训练期间一直存在
+            self.evaluator = AsyncEvaluator(self, **self.eval_config)
+
+        try:
+            self._fit_epochs()
+        finally:
+            if self.evaluator is not None:
+                self.evaluator.close()
+                self.evaluator = None
+            if self.profiler is not None:
+                self.profiler.stop()
+                self.profiler = None
+            if self.enable_checkpointManager:
+                # 等待异步写入的权重
+                self.checkpointManager.wait()
+
+    @contextlib.contextmanager
+    def _pause_profiler(self):
+        '''
+        测试期间暂停性能分析
+        分析器只按训练步推进，测试的计算不应混入训练步的记录窗口
+        不支持暂停时结束分析，已记录的部分照常导出
+        '''
+        if self.profiler is None:
+            yield
+            return
+        if not can_pause(self.profiler):
+            self.profiler.stop()
+            self.profiler = None
+            self._print('Profiler can not be paused, stopped before test.', verbose=1)
+            yield
+            return
+        with paused(self.profiler):
+            yield
+
+    def _fit_epochs(self):
+        '''逐轮训练和测试'''
         # 遍历批
         for epoch in range(self.epoch, self.num_epoch+1):
             # 开始训练
@@ -266,16 +839,28 @@ class Trainer:
                 text=f'Train Epoch:{self.epoch}/{self.num_epoch} Begin',
                 verbose=1)
             # 批训练
-            self._fit_batch(is_training=True)
+            self._record_epoch(self._fit_batch(is_training=True))
 
             # =======================================================
             # 开始测试
-            if self.enable_test:
+            if self.enable_test and self.evaluator is not None:
+                # 提交权重快照，测试在后台进行
+                self.evaluator.submit(self.epoch, self.raw_net.state_dict())
+                # 取回已完成的测试结果
+                self._collect_eval()
+            elif self.enable_test:
                 self._print(
                     text=f'Test Epoch:{self.epoch} Begin',
                     verbose=1)
                 # 批测试
-                self._fit_batch(is_training=False)
+                # 创建测试集的迭代器会从全局随机数生成器取种子
+                # 测试前后保持随机数状态不变，使训练与异步测试时一致
+                rng_state = tc.get_rng_state()
+                try:
+                    with self._pause_profiler():
+                        self._record_epoch(self._fit_batch(is_training=False))
+                finally:
+                    tc.set_rng_state(rng_state)
 
             # =======================================================
             # 保存权重
@@ -289,5 +874,230 @@ class Trainer:
                             verbose=1)
                 break
 
+        if self.evaluator is not None:
+            # 等待剩余的测试结果
+            self._collect_eval(drain=True)
+            if self.enable_checkpointManager and self.is_main:
+                # 等待异步写入的记录，避免被旧的记录覆盖
+                self.checkpointManager.wait()
+                self.summaryManager.save()
+
         self._print('\n========Finish========\n',
                     verbose=1)
+
+    def find_batch_size(self,
+                        data=None,
+                        max_batch_size: int = 4096,
+                        memory_limit_mb: Optional[float] = None,
+                        num_step: int = 5,
+                        num_warmup: int = 2) -> dict:
+        '''
+        试探吞吐量最大的训练批大小
+        用net、loss_fn、optimizer完整地训练若干步，批大小从训练加载器的批大小开始倍增
+        在内存不足或超过内存预算(CPU为常驻内存，CUDA为显存)时停止
+        结束后还原权重、优化器、梯度缩放器和随机数状态，不影响正式训练
+        结果写入根目录下的batch_size.json
+        参数:
+            data  用于试探的一个批，例如随机生成的数据，默认取训练集的第一个批
+                会被重复为需要的大小
+            memory_limit_mb  内存预算，默认为显存的90%或物理内存的80%
+            num_step  每个批大小计时的步数
+            num_warmup  每个批大小预热的步数
+        返回:
+            {'best_batch_size', 'memory_limit_mb', 'curve'}
+            curve为每个批大小的吞吐量(样本/秒)和内存峰值，参见search_batch_size
+        '''
+        if self.distributed:
+            raise ValueError(
+                'find_batch_size can not be used with distributed=True.')
+        if memory_limit_mb is None:
+            memory_limit_mb = default_memory_limit_mb(self.device)
+
+        def train_step(batch):
+            self.optimizer.zero_grad()
+            # 与正式训练一样拆分为微批
+            micro_datas = split_batch(batch, self.num_micro_batch)
+            for micro_data in micro_datas:
+                _, _, loss = self._forward_loss_fn(micro_data)
+                self.precisionManager.backward(
+                    loss * (len(micro_data[0]) / len(batch[0])))
+            self.precisionManager.step(self.optimizer)
+
+        # 创建训练集的迭代器也会消耗随机数，在取样本之前保存随机数状态
+        rng_state = get_rng_state()
+        # 试探会修改权重和优化器状态，结束后还原
+        state = snapshot_to_cpu({
+            'net': self.raw_net.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.precisionManager.state_dict()})
+        self.net.train()
+        try:
+            if data is None:
+                data = next(iter(self.data_train_loader))
+            data = move_to_device(data, self.device)
+            curve = search_batch_size(train_step, data,
+                                      batch_size=self.batch_size or 1,
+                                      max_batch_size=max_batch_size,
+                                      memory_limit_mb=memory_limit_mb,
+                                      device=self.device,
+                                      num_step=num_step,
+                                      num_warmup=num_warmup)
+        finally:
+            self.optimizer.zero_grad()
+            _ = self.raw_net.load_state_dict(state['net'])
+            self.optimizer.load_state_dict(state['optimizer'])
+            self.precisionManager.load_state_dict(state['scaler'])
+            set_rng_state(rng_state)
+
+        for record in curve:
+            self._print(
+                'Batch Size:{}, Status:{}, Speed:{}, Memory:{}'.format(
+                    record['batch_size'], record['status'],
+                    '-' if record['speed'] is None
+                    else '{:.1f} samples/s'.format(record['speed']),
+                    '-' if record['memory_mb'] is None
+                    else '{:.0f}MB'.format(record['memory_mb'])),
+                verbose=1)
+
+        records_ok = [record for record in curve if record['status'] == 'ok']
+        result = {
+            'best_batch_size': max(records_ok, key=lambda record: record['speed'])['batch_size']
+            if len(records_ok) > 0 else None,
+            'memory_limit_mb': memory_limit_mb,
+            'curve': curve,
+        }
+        self._print(f'Best Batch Size:{result["best_batch_size"]}', verbose=1)
+        if self.is_main:
+            with open(self.roor_dir/Path('batch_size.json'), 'w', encoding='utf-8') as fs:
+                json.dump(result,
+                          fp=fs,
+                          indent=4,
+                          ensure_ascii=False)
+        return result
+
+    def infer_forward(self, data):
+        '''
+        推理时的计算函数，返回网络的输出
+        数据没有标签，可以重新定义
+        '''
+        X = data[0] if isinstance(data, (list, tuple)) else data
+        # 分布式包装的网络在前向时会与其他进程通信，推理时直接使用原网络
+        net = self.raw_net if self.distributed else self.net
+        return net(X.to(self.device))
+
+    def infer(self,
+              data_loader,
+              output_dir: Union[str, Path, None] = None,
+              outputs: tuple = ('logits',),
+              topk: int = 5,
+              embedding_layer: Optional[str] = None,
+              auto_batch_size: bool = False,
+              max_batch_size: int = 4096,
+              memory_limit_mb: Optional[float] = None,
+              prefetch_config: Optional[dict] = None) -> dict:
+        '''
+        批量推理，输出写入文件
+        在inference_mode下按顺序遍历数据集，第i行输出对应第i个样本
+        输出在后台写入内存映射文件(样本数未知时为分块文件)，内存占用与数据集大小无关
+        参数:
+            output_dir  输出文件夹，默认为根目录下的inference
+            outputs  需要的输出
+                logits  网络的输出
+                topk  前topk个类别的分数(topk_values)和序号(topk_indices)
+                embedding  embedding_layer层的输出，展平为每个样本一行
+            embedding_layer  网络中的模块名，与named_modules一致
+            auto_batch_size  是否试探能够运行的最大批大小
+                从data_loader的批大小开始倍增，不超过max_batch_size和内存预算memory_limit_mb
+            prefetch_config  Prefetcher的参数，数据的读取与计算重叠
+        返回:
+            “名称-输出”的字典，参见OutputWriter.close
+        '''
+        if self.distributed:
+            # 每个进程会遍历整个数据集，并同时写入相同的输出文件
+            raise ValueError(
+                'infer can not be used with distributed=True, run it in a single process.')
+        unknown = set(outputs) - {'logits', 'topk', 'embedding'}
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown outputs {sorted(unknown)}.')
+        if 'embedding' in outputs and embedding_layer is None:
+            raise ValueError('The embedding output requires embedding_layer.')
+        if output_dir is None:
+            output_dir = self.roor_dir/Path('inference')
+
+        net = self.net
+        is_training = net.training
+        net.eval()
+
+        # 用前向钩子取出中间层的输出
+        embedding = {}
+        hook = None
+        if 'embedding' in outputs:
+            module = dict(self.raw_net.named_modules())[embedding_layer]
+            hook = module.register_forward_hook(
+                lambda module, input, output: embedding.update(value=output))
+
+        def forward(data):
+            with tc.inference_mode(), self.precisionManager.autocast():
+                return self.infer_forward(data)
+
+        writer = None
+        try:
+            batch_size = data_loader.batch_size
+            if auto_batch_size:
+                data = move_to_device(next(iter(data_loader)), self.device)
+                batch_size = find_batch_size(forward, data,
+                                             batch_size=batch_size,
+                                             max_batch_size=max_batch_size,
+                                             memory_limit_mb=memory_limit_mb,
+                                             device=self.device)
+                data = None
+                self._print(f'Inference Batch Size:{batch_size}', verbose=1)
+            # 按顺序读取，与样本的序号对应
+            data_loader = rebatch_loader(data_loader, batch_size)
+            try:
+                num_sample = len(data_loader.dataset)
+            except TypeError:
+                # 可迭代数据集，长度未知
+                num_sample = None
+            writer = OutputWriter(output_dir, num_sample=num_sample)
+
+            time_begin = time.time()
+            num_done = 0
+            for data in Prefetcher(data_loader, device=self.device,
+                                   **(prefetch_config or {})):
+                Y = forward(data)
+                batch_outputs = {}
+                if 'logits' in outputs:
+                    batch_outputs['logits'] = Y.float()
+                if 'topk' in outputs:
+                    values, indices = Y.float().topk(
+                        min(topk, Y.shape[-1]), dim=-1)
+                    batch_outputs['topk_values'] = values
+                    batch_outputs['topk_indices'] = indices
+                if 'embedding' in outputs:
+                    batch_outputs['embedding'] = embedding.pop('value').flatten(1).float()
+                writer.put(batch_outputs)
+                num_done += len(Y)
+                self._print(f'\rInference Sample:{num_done}'
+                            + (f'/{num_sample}' if num_sample is not None else ''),
+                            end='', verbose=2)
+            results = writer.close()
+            writer = None
+        finally:
+            if writer is not None:
+                # 出现异常时结束写入线程
+                try:
+                    _ = writer.close()
+                except Exception:
+                    pass
+            if hook is not None:
+                hook.remove()
+            net.train(is_training)
+
+        time_delta = time.time() - time_begin
+        self._print('', end='\n', verbose=2)
+        self._print(
+            'Inference Samples:{}, Time:{:.2f}s, Speed:{:.1f} samples/s'.format(
+                num_done, time_delta, num_done / max(time_delta, 1e-9)),
+            verbose=1)
+        return results
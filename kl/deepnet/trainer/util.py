@@ -1,4 +1,7 @@
 from typing import Union, Optional
+import os
+import resource
+import sys
 
 
 def number2string(
@@ -13,3 +16,67 @@ def number2string(
         # 浮点数
         template = '{:.%df}' % precision
         return template.format(value)
+
+
+def split_batch(data, num_split: int = 1) -> list:
+    '''
+    将一个批数据沿第0维拆分为多个微批
+    参数:
+        data  批数据，由张量组成的列表或元组
+        num_split  微批的数量，批大小不足时数量会减少
+    返回:
+        微批的列表
+    '''
+    if num_split <= 1:
+        return [data]
+
+    # 逐项拆分
+    chunks = [item.chunk(num_split, dim=0) for item in data]
+    return [tuple(chunk[idx] for chunk in chunks)
+            for idx in range(len(chunks[0]))]
+
+
+def loader_layout(data_loader) -> Optional[tuple]:
+    '''
+    数据加载器每轮的样本数和批大小，无法确定时返回None
+    经过Prefetcher包装时也可以
+    '''
+    while hasattr(data_loader, 'data_loader'):
+        data_loader = data_loader.data_loader
+    batch_size = getattr(data_loader, 'batch_size', None)
+    sampler = getattr(data_loader, 'sampler', None)
+    if batch_size is None or sampler is None:
+        return None
+    try:
+        num_sample = len(sampler)
+    except TypeError:
+        # 可迭代数据集没有长度
+        return None
+    if getattr(data_loader, 'drop_last', False):
+        num_sample = num_sample // batch_size * batch_size
+    return num_sample, batch_size
+
+
+def peak_rss_mb() -> float:
+    '''当前进程的峰值常驻内存(MB)'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS的单位是字节
+        return peak / 1024**2
+    # Linux的单位是KB
+    return peak / 1024
+
+
+def current_rss_mb() -> float:
+    '''当前进程的常驻内存(MB)'''
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            num_page = int(fp.read().split()[1])
+        return num_page * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except OSError:
+        return peak_rss_mb()
+
+
+def total_memory_mb() -> float:
+    '''物理内存总量(MB)'''
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024**2